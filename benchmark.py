@@ -0,0 +1,283 @@
+import os
+import sys
+import json
+import math
+import shutil
+import asyncio
+import argparse
+import platform
+import tempfile
+import subprocess
+import random
+import wave
+import tracemalloc
+from array import array
+from pathlib import Path
+from typing import Dict, List, Any, Callable
+from time import perf_counter
+from loguru import logger
+
+from voice_audio_timestamps import VoiceDetect, build_voice_detection
+from clean_timestamps import Timestamps
+from split_by_timestamp import Split, run_split
+from merge_audio_items import MergeAudioItems
+
+# a timing counts as a regression when it is this much slower than the baseline
+DEFAULT_TOLERANCE = 0.15
+
+
+def make_synthetic_wav(path: Path,
+                       seconds: int = 3600,
+                       sample_rate: int = 16000,
+                       speech_ratio: float = 0.5,
+                       seed: int = 0) -> Path:
+    """
+    Writes a mono 16-bit .wav made of one-second blocks of tone + noise ("speech") and silence.
+    speech_ratio is the share of speech blocks. Nothing is downloaded.
+    """
+    rng = random.Random(seed)
+    speech = array('h', (int(6000 * math.sin(2 * math.pi * 180 * i / sample_rate) + rng.gauss(0, 1500))
+                         for i in range(sample_rate))).tobytes()
+    silence = bytes(sample_rate * 2)
+    with wave.open(str(path), 'wb') as wf:
+        wf.setnchannels(1)
+        wf.setsampwidth(2)
+        wf.setframerate(sample_rate)
+        for _ in range(seconds):
+            wf.writeframes(speech if rng.random() < speech_ratio else silence)
+    return Path(path)
+
+def measure(call: Callable[[], Any]) -> Dict[str, float]:
+    """
+    Runs a call once for wall time, and once under tracemalloc for peak Python allocations.
+    """
+    t1_start = perf_counter()
+    call()
+    t1_stop = perf_counter()
+    tracemalloc.start()
+    call()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {'seconds': t1_stop - t1_start, 'peak_mb': peak / 2**20}
+
+def best_of(call: Callable[[], Any], repeat: int = 3) -> float:
+    """
+    Fastest wall time of repeat runs; the minimum is the least noisy estimate on a shared box.
+    """
+    seconds = []
+    for _ in range(repeat):
+        t1_start = perf_counter()
+        call()
+        seconds.append(perf_counter() - t1_start)
+    return min(seconds)
+
+def wav_seconds(path: Path) -> float:
+    with wave.open(str(path), 'rb') as wf:
+        return wf.getnframes() / wf.getframerate()
+
+def bench_frame_source(path: Path, frame_duration_ms: int = 30) -> Dict[str, Dict[str, float]]:
+    """
+    Before/after for VAD input: the file read into memory and cut into bytes copies + a Frame per frame
+    (frame_generator) vs. the file memory-mapped and cut into memoryview frames (frame_views).
+    """
+    def frame_copies():
+        wave_info = VoiceDetect.read_wave(path)
+        frames = VoiceDetect.frame_generator(wave_info.pcm_data, wave_info.sample_rate, frame_duration_ms)
+        return VoiceDetect.get_voiced_frames(frames, wave_info.sample_rate)
+
+    def frame_views():
+        with VoiceDetect.map_wave(path) as source:
+            wave_info = VoiceDetect.vad_input(source)
+            frames = VoiceDetect.frame_views(wave_info.pcm_data, wave_info.sample_rate, frame_duration_ms)
+            return VoiceDetect.get_voiced_frames(frames, wave_info.sample_rate)
+
+    results = {}
+    for mode, call in (('frame_generator', frame_copies), ('frame_views', frame_views)):
+        results[mode] = measure(call)
+        logger.info(f"{mode}: {results[mode]}")
+    return results
+
+def bench_vad(path: Path, modes=('memory', 'mmap', 'stream'), repeat: int = 3) -> Dict[str, Dict[str, float]]:
+    """
+    VAD throughput of one file per mode, as a realtime factor (seconds of audio per second of wall time).
+    """
+    audio_seconds = wav_seconds(path)
+    results = {}
+    for mode in modes:
+        seconds = best_of(lambda: VoiceDetect().do_timestamps(path, mode), repeat)
+        results[mode] = {'seconds': seconds, 'realtime_factor': audio_seconds / seconds}
+        logger.info(f"VAD {mode}: {results[mode]}")
+    return results
+
+def bench_split_export(path: Path, segment_counts=(10, 100, 1000), repeat: int = 3) -> Dict[str, Dict[str, Dict[str, float]]]:
+    """
+    build_split with parts pickled to the workers (segments) vs. workers reading their own range (ranges).
+    Parts are spread evenly over the file, half a slot each.
+    """
+    path = Path(path).resolve()
+    seconds = wav_seconds(path)
+    results = {}
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as output_directory:
+        os.chdir(output_directory)
+        try:
+            for segment_count in segment_counts:
+                slot = seconds / segment_count
+                timestamps = [{'start': i * slot, 'stop': i * slot + slot / 2} for i in range(segment_count)]
+                results[str(segment_count)] = {}
+                for mode in ('segments', 'ranges'):
+                    split_seconds = best_of(lambda: run_split(path, timestamps, mode=mode), repeat)
+                    results[str(segment_count)][mode] = {'seconds': split_seconds, 
+                                                         'segments_per_s': segment_count / split_seconds}
+                    for output_path in Path(output_directory).glob('*.wav'):
+                        output_path.unlink()
+                logger.info(f"{segment_count} segments: {results[str(segment_count)]}")
+        finally:
+            os.chdir(cwd)
+    return results
+
+def bench_merge(path: Path, part_counts=(10, 100, 1000), repeat: int = 3) -> Dict[str, Dict[str, float]]:
+    """
+    Streaming merge of N _ptN.wav parts cut evenly from the file, in MB of output per second.
+    """
+    with wave.open(str(path), 'rb') as wf:
+        sample_rate = wf.getframerate()
+        pcm_data = wf.readframes(wf.getnframes())
+    seconds = len(pcm_data) / (2 * sample_rate)
+    results = {}
+    for part_count in part_counts:
+        slot = seconds / part_count
+        timestamps = [{'start': i * slot, 'stop': (i + 1) * slot} for i in range(part_count)]
+        with tempfile.TemporaryDirectory() as output_directory:
+            parts = Split.write_pcm_segments(pcm_data, sample_rate, timestamps, 'bench', output_directory)
+            merge_seconds = best_of(lambda: MergeAudioItems.merge_stream(parts), repeat)
+        results[str(part_count)] = {'seconds': merge_seconds, 'mb_per_s': len(pcm_data) / 2**20 / merge_seconds}
+        logger.info(f"Merge {part_count} parts: {results[str(part_count)]}")
+    return results
+
+def bench_scaling(path: Path, worker_counts=(1, 2, 4), copies: int = 8) -> Dict[str, Dict[str, float]]:
+    """
+    build_voice_detection over copies of the file with each max_workers value.
+    Each pool is warmed up with one untimed run first, so worker start-up isn't counted.
+    """
+    audio_seconds = wav_seconds(path) * copies
+    results = {}
+    with tempfile.TemporaryDirectory() as corpus_directory:
+        for i in range(copies):
+            shutil.copy(path, Path(corpus_directory) / f'copy_{i}.wav')
+        wav_glob = str(Path(corpus_directory) / '*.wav')
+        for max_workers in worker_counts:
+            call = lambda: asyncio.run(build_voice_detection(wav_glob, max_workers=max_workers))
+            call()
+            seconds = best_of(call, repeat=1)
+            results[str(max_workers)] = {'seconds': seconds, 'realtime_factor': audio_seconds / seconds}
+            logger.info(f"VAD with {max_workers} workers: {results[str(max_workers)]}")
+    return results
+
+def bench_cold_start(modules=('fused_pipeline', 'corpus_pipeline'), repeat: int = 5) -> Dict[str, float]:
+    """
+    What a fresh worker pays to import the pipeline (minus bare interpreter start-up).
+    """
+    package_directory = Path(__file__).resolve().parent
+    run = lambda code: subprocess.run([sys.executable, '-c', code], cwd=package_directory, check=True)
+    interpreter_seconds = best_of(lambda: run('pass'), repeat)
+    seconds = best_of(lambda: run('import ' + ', '.join(modules)), repeat)
+    results = {'seconds': seconds - interpreter_seconds, 'interpreter_seconds': interpreter_seconds}
+    logger.info(f"Cold start: {results}")
+    return results
+
+def bench_object_memory(count: int = 100000) -> Dict[str, Dict[str, float]]:
+    """
+    Bytes and construction time per object for the types the hot paths create in bulk.
+    """
+    def per_object(build):
+        tracemalloc.start()
+        t1_start = perf_counter()
+        objects = build()
+        seconds = perf_counter() - t1_start
+        size, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        del objects
+        return {'bytes': size / count, 'microseconds': seconds / count * 1e6}
+
+    times = [{'start': i * 0.03, 'stop': i * 0.03 + 0.03} for i in range(count)]
+    pcm_data = bytes(480 * 2 * count)
+    results = {
+               'timestamps': per_object(lambda: [Timestamps(start=ts['start'], stop=ts['stop']) for ts in times]),
+               'split_parts': per_object(lambda: Split.get_ranges('bench.wav', times)),
+               'frames': per_object(lambda: VoiceDetect.frame_generator(pcm_data, 16000, 30))
+               }
+    logger.info(f"Per object: {results}")
+    return results
+
+def run_suite(seconds: int = 600,
+              sample_rate: int = 16000,
+              speech_ratio: float = 0.5,
+              worker_counts=(1, 2, 4)) -> Dict[str, Any]:
+    """
+    Runs every benchmark on one synthetic file and returns the results with the settings and machine they came from.
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        path = make_synthetic_wav(Path(directory) / 'bench_synthetic.wav', seconds, sample_rate, speech_ratio)
+        data = {
+                'settings': {'seconds': seconds, 'sample_rate': sample_rate, 'speech_ratio': speech_ratio,
+                             'worker_counts': list(worker_counts)},
+                'machine': {'python': platform.python_version(), 'platform': platform.platform(), 
+                            'cpu_count': os.cpu_count()},
+                'vad': bench_vad(path),
+                'split': bench_split_export(path),
+                'merge': bench_merge(path),
+                'scaling': bench_scaling(path, worker_counts),
+                'cold_start': bench_cold_start(),
+                'objects': bench_object_memory()
+                }
+    return data
+
+def timings(results: Dict[str, Any], prefix: str = '') -> Dict[str, float]:
+    """
+    Flattens the 'seconds' entries of a results dict to {'vad.memory': 1.2, ...}.
+    """
+    flat = {}
+    for key, value in results.items():
+        if key == 'seconds' and isinstance(value, float):
+            flat[prefix.rstrip('.')] = value
+        elif isinstance(value, dict):
+            flat.update(timings(value, prefix + key + '.'))
+    return flat
+
+def compare(results: Dict[str, Any], baseline: Dict[str, Any], tolerance: float = DEFAULT_TOLERANCE) -> List[str]:
+    """
+    Compares every timing against the baseline; returns the names of those more than tolerance slower.
+    Baselines from other settings aren't comparable, so those are refused.
+    """
+    if results['settings'] != baseline['settings']:
+        raise ValueError(f"Baseline was run with different settings: {baseline['settings']}")
+    current, previous = timings(results), timings(baseline)
+    regressions = []
+    for name in sorted(current.keys() & previous.keys()):
+        change = current[name] / previous[name] - 1
+        logger.info(f"{name}: {previous[name]:.4f}s -> {current[name]:.4f}s ({change:+.1%})")
+        if change > tolerance:
+            regressions.append(name)
+    return regressions
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Offline benchmarks on synthetic audio')
+    parser.add_argument('--seconds', type=int, default=600)
+    parser.add_argument('--sample-rate', type=int, default=16000)
+    parser.add_argument('--speech-ratio', type=float, default=0.5)
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--output', default='benchmark_results.json')
+    parser.add_argument('--baseline', help='results JSON of an earlier run to compare against')
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE)
+    args = parser.parse_args()
+    results = run_suite(args.seconds, args.sample_rate, args.speech_ratio, args.workers)
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    logger.info(f"Benchmark results written: {args.output}")
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        if regressions:
+            logger.info(f"Slower than baseline: {regressions}")
+            raise SystemExit(1)
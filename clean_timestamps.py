@@ -1,11 +1,13 @@
 from pydantic import BaseModel
 from pathlib import Path
-from typing import List
+from typing import List, NamedTuple
 from loguru import logger
 from time import perf_counter
 
-# import these, maybe
-class Timestamps(BaseModel):
+from instrumentation import instrumented
+
+# a plain tuple, since detection makes one per speech run; pydantic models below still validate lists of them
+class Timestamps(NamedTuple):
     start: float
     stop: float
 
@@ -18,6 +20,7 @@ class CleanTimestamps(BaseModel):
     raw_timestamps: List[Timestamps] = None
     clean_timestamps: List[Timestamps] = None
 
+    @instrumented('clean')
     def clean(raw_timestamps: VoiceDetect, timestamp_merge_window: int = 1) -> 'CleanTimestamps':
         """
         Merges timestamps that are within a time window together, to consolidate values.
@@ -26,7 +29,7 @@ class CleanTimestamps(BaseModel):
         t1_start = perf_counter()
         logger.info(f"Starting timestamp cleansing!")
         clean_timestamps = []
-        ts_items = [item.dict() for item in raw_timestamps.timestamps]
+        ts_items = [item._asdict() for item in raw_timestamps.timestamps]
         for item in ts_items:
             # padding: -- consider making this an arg
             # item['start'] - 1 # don't let this be a negative value
@@ -1,27 +1,31 @@
-from pydub import AudioSegment
 from pathlib import Path
 from loguru import logger
 from pydantic import BaseModel
 from typing import List, Any, Tuple
 from time import perf_counter
+import os
+import subprocess
 
 import asyncio
 from functools import partial
-from asyncio.events import AbstractEventLoop
-from concurrent.futures import ProcessPoolExecutor
 from glob import glob
 
+from worker_pool import get_process_pool
+from instrumentation import instrumented, run_in_pool, file_size
+
 class Clips(BaseModel):
     input_path: Path = None
     output_paths_and_parts: List[Tuple[Path, Any]] = None
 
     @staticmethod
+    @instrumented('clip_export_audio', lambda result, *args, **kwargs: {'bytes_written': file_size(result)})
     def export_audio(output_filename: Path, audio_segment: Any) -> Path:
         if Path(output_filename).suffix == '.mp3':
             audio_segment.export(output_filename, format='mp3')
         return output_filename
 
     def get_audio_partitions(input_path: Path, cutoff_threshold: int = 3600, chunk_duration: int = 1800) -> 'Clips':
+        from pydub import AudioSegment
         filename = Path(input_path).stem
         if Path(input_path).suffix == '.mp3':
             audio_segment = AudioSegment.from_mp3(input_path)
@@ -55,41 +59,124 @@ class Clips(BaseModel):
             logger.info('Doing nothing to this file; it is smaller than the cutoff threshold')
             data = {
                     'input_path': input_path,
-                    'output_paths_and_parts': (input_path, None)
+                    'output_paths_and_parts': []
                     }
             return Clips(**data)
-            
+
+    @staticmethod
+    @instrumented('ffmpeg.probe_duration')
+    def probe_duration(input_path: Path) -> float:
+        """
+        Duration in seconds from the container metadata (ffprobe), without decoding any audio.
+        """
+        command = ['ffprobe', '-v', 'error', '-show_entries', 'format=duration', 
+                   '-of', 'default=noprint_wrappers=1:nokey=1', str(input_path)]
+        return float(subprocess.run(command, capture_output=True, text=True, check=True).stdout.strip())
+
+    def get_partition_ranges(input_path: Path, cutoff_threshold: int = 3600, chunk_duration: int = 1800) -> 'Clips':
+        """
+        Like get_audio_partitions, but reads the duration from the file's metadata instead of decoding it.
+        Each part is (output path, (start_ms, stop_ms)); files under the cutoff get no parts.
+        """
+        path = Path(input_path)
+        total_time_ms = int(Clips.probe_duration(path) * 1000)
+        output_paths_and_ranges = []
+        if total_time_ms > cutoff_threshold * 1000:
+            chunk_time_increment = chunk_duration * 1000
+            for part_number, chunk_time_count in enumerate(range(0, total_time_ms, chunk_time_increment), start=1):
+                output_path = path.stem + '_pt' + str(part_number) + path.suffix
+                chunk_range = (chunk_time_count, min(chunk_time_count + chunk_time_increment, total_time_ms))
+                output_paths_and_ranges.append((output_path, chunk_range))
+        else:
+            logger.info(f"Doing nothing to this file; it is smaller than the cutoff threshold: {input_path}")
+        data = {
+                'input_path': input_path,
+                'output_paths_and_parts': output_paths_and_ranges
+                }
+        return Clips(**data)
+
+    @staticmethod
+    def range_command(input_path: Path, output_filename: Path, start_ms: int, stop_ms: int, stream_copy: bool) -> List[str]:
+        """
+        ffmpeg command for one chunk. -ss before -i seeks in the container instead of decoding up to start_ms,
+        and ffmpeg streams the chunk through, so memory stays flat however long the chunk is.
+        """
+        command = ['ffmpeg', '-nostdin', '-loglevel', 'error', '-y', 
+                   '-ss', f'{start_ms / 1000:.3f}', '-i', str(input_path), 
+                   '-t', f'{(stop_ms - start_ms) / 1000:.3f}', '-map', '0:a:0']
+        if stream_copy:
+            command += ['-c', 'copy']
+        return command + [str(output_filename)]
+
+    @staticmethod
+    @instrumented('clip_export_range', lambda result, *args, **kwargs: {'bytes_written': file_size(result)})
+    def export_range(input_path: Path, output_filename: Path, start_ms: int, stop_ms: int) -> Path:
+        """
+        Seeks to the start_ms-stop_ms chunk of the source and re-encodes just that chunk.
+        Meant for pool workers: just a path and two ints get pickled, never audio.
+        """
+        subprocess.run(Clips.range_command(input_path, output_filename, start_ms, stop_ms, False), check=True)
+        return output_filename
+
+    @staticmethod
+    @instrumented('ffmpeg.clip_copy', lambda result, *args, **kwargs: {'bytes_written': file_size(result)})
+    def copy_range(input_path: Path, output_filename: Path, start_ms: int, stop_ms: int) -> Path:
+        """
+        Like export_range, but copies the compressed frames as they are: no decoding or re-encoding at all.
+        Cuts land on the nearest frame boundary (26 ms for MP3) instead of the exact millisecond.
+        """
+        subprocess.run(Clips.range_command(input_path, output_filename, start_ms, stop_ms, True), check=True)
+        return output_filename
+
 
 async def build_clips(input_path: Path, 
                       cutoff_threshold: int = 3600, 
                       chunk_duration: int = 1800, 
-                      max_workers: int = 8) -> Clips:
+                      max_workers: int = None,
+                      mode: str = 'copy') -> List[Clips]:
     """
-    Prepares partitions of audio clips and exports to current directory.
+    Prepares partitions of audio clips and exports to current directory, for every file matching the glob input_path.
     For each partition, adds a _pt1, _pt2, etc to each output filename.
+    Mode can be: copy (workers get (path, start_ms, stop_ms) and stream-copy their chunk with ffmpeg),
+    ranges (the same, but the chunk is re-encoded)
+    or segments (the whole file is decoded here and each chunk is pickled to the workers)
+    Files under cutoff_threshold seconds are left alone; only their metadata is read.
+    All chunks of all files run in parallel on the shared pool. Paths are made absolute here,
+    since the pool's workers keep the directory they were started in.
     """
     t1_start = perf_counter()
     logger.info(f"Starting clip & export!")
-    parts = Clips.get_audio_partitions(input_path, cutoff_threshold, chunk_duration)
-    if parts:
-        parts = parts.output_paths_and_parts
-        with ProcessPoolExecutor(max_workers) as process_pool:
-            loop: AbstractEventLoop = asyncio.get_running_loop()
-            calls: List[partial[int]] = [partial(Clips.export_audio, part[0], part[1]) for part in parts]
-            call_coros = []
-            for call in calls: call_coros.append(loop.run_in_executor(process_pool, call))
-            results = await asyncio.gather(*call_coros)
-            for result in results:
-                logger.info(f"Export completed for file: {result}")
-        t1_stop = perf_counter()
-        logger.info(f"Task complete! Elapsed time: {t1_stop - t1_start}")
-        return parts
-    else: pass
+    clips = []
+    calls = []
+    for path in glob(str(input_path)):
+        path = os.path.abspath(path)
+        if mode == 'segments':
+            clip = Clips.get_audio_partitions(path, cutoff_threshold, chunk_duration)
+        else:
+            clip = Clips.get_partition_ranges(path, cutoff_threshold, chunk_duration)
+        clip.output_paths_and_parts = [(os.path.abspath(output_path), part) for output_path, part in clip.output_paths_and_parts]
+        if mode == 'segments':
+            calls += [partial(Clips.export_audio, part[0], part[1]) for part in clip.output_paths_and_parts]
+        else:
+            export = Clips.copy_range if mode == 'copy' else Clips.export_range
+            calls += [partial(export, path, part[0], *part[1]) for part in clip.output_paths_and_parts]
+        clips.append(clip)
+    if calls:
+        process_pool = get_process_pool(max_workers)
+        call_coros = []
+        for call in calls: call_coros.append(run_in_pool(process_pool, call))
+        results = await asyncio.gather(*call_coros)
+        for result in results:
+            logger.info(f"Export completed for file: {result}")
+    t1_stop = perf_counter()
+    logger.info(f"Task complete! Elapsed time: {t1_stop - t1_start}")
+    return clips
 
 def run_clips(input_path: Path = None, 
               cutoff_threshold: int = 3600, 
-              chunk_duration: int = 1800):
-    return asyncio.run(build_clips(input_path, cutoff_threshold, chunk_duration))
+              chunk_duration: int = 1800,
+              mode: str = 'copy') -> List[Clips]:
+    return asyncio.run(build_clips(input_path, cutoff_threshold, chunk_duration, mode=mode))
 
 if __name__ == '__main__':
     run_clips()
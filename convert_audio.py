@@ -1,22 +1,27 @@
 from pydantic import BaseModel
 from pathlib import Path
-import regex as re
+import re
 import subprocess
-from typing import Union, Any, List
+import os
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
+from typing import Union, Any, List, AsyncIterator, Iterator, IO
 from time import perf_counter
 from loguru import logger
 
 import asyncio
 from functools import partial
-from asyncio.events import AbstractEventLoop
-from concurrent.futures import ProcessPoolExecutor
 from glob import glob
 
+from scheduler import map_bounded
+from instrumentation import instrumented, measure, file_size
+
 class AudioConversion(BaseModel):
     input_path: Path = None
     output_path: Path = None
 
     @staticmethod
+    @instrumented('ffmpeg.m4a_to_wav', lambda result, input_path, *args, **kwargs: {'bytes_read': file_size(input_path), 'bytes_written': file_size(result)})
     def m4a_to_wav(input_path: Union[Path, Any]) -> Union[Path, Any]:
         out_path = re.findall(r'.*\.m4a$', input_path)[0]
         output_path = re.sub(r'm4a$', 'wav', out_path)
@@ -25,23 +30,80 @@ class AudioConversion(BaseModel):
         return output_path
 
     @staticmethod
-    def mp3_to_wav(input_path: Union[Path, Any]) -> Union[Path, Any]:
-        output_path = Path(input_path).stem + r'.wav'
+    @instrumented('ffmpeg.mp3_to_wav', lambda result, input_path, *args, **kwargs: {'bytes_read': file_size(input_path), 'bytes_written': file_size(result)})
+    def mp3_to_wav(input_path: Union[Path, Any], output_directory: Path = '.') -> Union[Path, Any]:
+        output_path = str(Path(output_directory) / (Path(input_path).stem + r'.wav'))
         # bash: ffmpeg -ss 00:00:00 -i input_path  out_path
         subprocess.call(['ffmpeg', '-ss', '00:00:00', '-i', input_path, '-ac', '1', '-ar', '16000', output_path])
         return output_path
 
     @staticmethod
-    def wav_to_mp3(input_path: Union[Path, Any]) -> Union[Path, Any]:
+    @instrumented('ffmpeg.wav_to_mp3', lambda result, input_path, *args, **kwargs: {'bytes_read': file_size(input_path), 'bytes_written': file_size(result)})
+    def wav_to_mp3(input_path: Union[Path, Any], output_directory: Path = '.') -> Union[Path, Any]:
         # bash: ffmpeg -i input.wav -vn -ar 44100 -ac 2 -b:a 192k output.mp3
-        output_path = Path(input_path).stem + r'.mp3'
+        output_path = str(Path(output_directory) / (Path(input_path).stem + r'.mp3'))
         subprocess.call(['ffmpeg', '-i', input_path, '-vn', '-ar', '48000', '-ac', '2', '-b:a', '192k', output_path])
         return output_path
 
-    def convert(self, path: Union[Path, Any], input_type: str) -> 'AudioConversion':
+    @staticmethod
+    def pcm_output_args(sample_rate: int = 16000) -> List[str]:
+        # 16-bit mono PCM, what webrtcvad takes
+        return ['-f', 's16le', '-ac', '1', '-ar', str(sample_rate)]
+
+    @staticmethod
+    @contextlib.contextmanager
+    def pcm_stream(input_path: Union[Path, Any], sample_rate: int = 16000) -> Iterator[IO[bytes]]:
+        """
+        Decodes audio with FFMPEG straight to a pipe; nothing is written to disk.
+        Yields ffmpeg's stdout, which carries 16-bit mono PCM at sample_rate.
+        Raises CalledProcessError if ffmpeg fails, so a partial decode is never taken for the whole file.
+        """
+        command = ['ffmpeg', '-nostdin', '-loglevel', 'error', '-i', str(input_path)]
+        command += AudioConversion.pcm_output_args(sample_rate) + ['pipe:1']
+        with measure('ffmpeg.pcm_stream') as counters:
+            counters['bytes_read'] = file_size(input_path)
+            process = subprocess.Popen(command, stdout=subprocess.PIPE)
+            try:
+                yield process.stdout
+            finally:
+                process.stdout.close()
+                process.wait()
+            if process.returncode != 0:
+                raise subprocess.CalledProcessError(process.returncode, command)
+
+    @staticmethod
+    @instrumented('ffmpeg.decode_batch', lambda result, input_paths, *args, **kwargs: 
+                  {'bytes_read': sum(map(file_size, input_paths)), 'pcm_bytes': sum(map(len, result))})
+    def decode_batch(input_paths: List[Union[Path, Any]], sample_rate: int = 16000) -> List[bytes]:
+        """
+        Decodes many (short) files with a single FFMPEG process: every file is an input,
+        mapped to its own pipe. Returns the 16-bit mono PCM of each file, in order.
+        """
+        pipes = [os.pipe() for _ in input_paths]
+        command = ['ffmpeg', '-nostdin', '-loglevel', 'error']
+        for input_path in input_paths:
+            command += ['-i', str(input_path)]
+        for index, (_, write_fd) in enumerate(pipes):
+            command += ['-map', f'{index}:a:0'] + AudioConversion.pcm_output_args(sample_rate) + [f'pipe:{write_fd}']
+        process = subprocess.Popen(command, pass_fds=[write_fd for _, write_fd in pipes])
+        for _, write_fd in pipes:
+            os.close(write_fd)
+
+        def read_pipe(read_fd: int) -> bytes:
+            with os.fdopen(read_fd, 'rb') as pipe:
+                return pipe.read()
+
+        # every pipe has to be drained at the same time, or ffmpeg blocks on the first full one
+        with ThreadPoolExecutor(len(pipes)) as readers:
+            pcm = list(readers.map(read_pipe, [read_fd for read_fd, _ in pipes]))
+        if process.wait() != 0:
+            raise subprocess.CalledProcessError(process.returncode, command)
+        return pcm
+
+    def convert(self, path: Union[Path, Any], input_type: str, output_directory: Path = '.') -> 'AudioConversion':
         """
         Converts audio with FFMPEG; converted audio lives in 
-        current directory. Args: path to be converted, input file type.
+        output_directory (default: current directory). Args: path to be converted, input file type.
         Input type can be: mp3 wav m4a
         """
         logger.info("Starting audio conversion!")
@@ -56,26 +118,33 @@ class AudioConversion(BaseModel):
         if input_type == 'mp3':
             if path_.suffix == '.mp3':
                 logger.info("Converting mp3 to wav!")
-                data['output_path'] = self.mp3_to_wav(path)
+                data['output_path'] = self.mp3_to_wav(path, output_directory)
                 t1_stop = perf_counter()     
         if input_type == 'wav':
             if path_.suffix == '.wav':
                 logger.info("Converting wav to mp3!")
-                data['output_path'] = self.wav_to_mp3(path)
+                data['output_path'] = self.wav_to_mp3(path, output_directory)
                 t1_stop = perf_counter()
         return AudioConversion(**data)
 
-async def build_convert(audio_file_directory: Union[Path, Any], input_type: str, max_workers=8) -> AudioConversion:
+async def iter_convert(audio_file_directory: Union[Path, Any], 
+                       input_type: str, 
+                       max_workers=None, 
+                       max_in_flight: int = None) -> AsyncIterator[AudioConversion]:
+    """
+    Conversion over a glob with at most max_in_flight files submitted at once (see scheduler).
+    Yields each file's result as soon as it completes. Converted files go to the current directory
+    of this process, not of the pool's workers.
+    """
+    calls = (partial(AudioConversion().convert, os.path.abspath(audio), input_type, os.getcwd()) 
+             for audio in glob(audio_file_directory))
+    async for result in map_bounded(calls, max_in_flight, max_workers):
+        logger.info(f"Conversion completed. Output file: {result.output_path}")
+        yield result
+
+async def build_convert(audio_file_directory: Union[Path, Any], input_type: str, max_workers=None) -> AudioConversion:
     t1_start = perf_counter()
-    with ProcessPoolExecutor(max_workers) as process_pool:
-        loop: AbstractEventLoop = asyncio.get_running_loop()
-        audio_files = glob(audio_file_directory)
-        calls: List[partial[int]] = [partial(AudioConversion().convert, audio, input_type) for audio in audio_files]
-        call_coros = []
-        for call in calls: call_coros.append(loop.run_in_executor(process_pool, call))
-        results = await asyncio.gather(*call_coros)
-        for result in results:
-            logger.info(f"Conversion completed. Output file: {result.output_path}")
+    results = [result async for result in iter_convert(audio_file_directory, input_type, max_workers)]
     t1_stop = perf_counter()
     logger.info(f"Task complete! Elapsed time: {t1_stop - t1_start}")
     return results
@@ -0,0 +1,136 @@
+from pathlib import Path
+from typing import List, AsyncIterator
+from loguru import logger
+from time import perf_counter
+import os
+
+import asyncio
+from functools import partial
+from glob import glob
+
+from scheduler import pipeline_bounded
+from manifest import Manifest
+from convert_audio import AudioConversion
+from voice_audio_timestamps import VoiceDetect
+from clean_timestamps import CleanTimestamps
+from split_by_timestamp import Split
+
+def convert_stage(path: Path, input_type: str = None, output_directory: Path = '.') -> Path:
+    if input_type is None:
+        return path
+    return AudioConversion().convert(path, input_type, output_directory).output_path
+
+def detect_stage(wav_path: Path, mode: str = 'memory') -> VoiceDetect:
+    return VoiceDetect().do_timestamps(wav_path, mode)
+
+def split_stage(detected: VoiceDetect, timestamp_merge_window: int = 1, output_root: Path = '.') -> Split:
+    """
+    Cleans the timestamps and writes the parts into a directory named after the file, under output_root.
+    The returned Split carries the full output paths.
+    """
+    cleaned = CleanTimestamps.clean(detected, timestamp_merge_window)
+    output_directory = Path(output_root) / Path(detected.path).stem
+    os.makedirs(output_directory, exist_ok=True)
+    split = Split.get_ranges(detected.path, [ts._asdict() for ts in cleaned.clean_timestamps])
+    split.output_paths_and_parts = [(str(output_directory / output_path), part_range)
+                                    for output_path, part_range in split.output_paths_and_parts]
+    Split.export_ranges(detected.path, split.output_paths_and_parts)
+    return split
+
+def split_outputs(split: Split) -> List[Path]:
+    # a no-op join for full paths; older records only hold the part names
+    output_directory = Path(split.input_path).stem
+    return [Path(output_directory) / output_path for output_path, _ in split.output_paths_and_parts]
+
+def corpus_resume(manifest: Manifest, stage_params: List[dict]):
+    """
+    Builds the pipeline_bounded resume hook: each file starts after the last stage the manifest
+    has a valid record for, whose outputs are still on disk. A fully done file starts past the
+    end, so its Split comes straight from the manifest.
+    """
+    def resume(path):
+        manifest.refresh(path)
+        split = manifest.outputs(path, 'split', stage_params[2])
+        if split is not None:
+            split = Split(**split)
+            if all(os.path.exists(output_path) for output_path in split_outputs(split)):
+                logger.info(f"Already split, skipping: {path}")
+                return 3, split
+        detected = manifest.outputs(path, 'detect', stage_params[1])
+        if detected is not None and os.path.exists(detected['path']):
+            return 2, VoiceDetect(**detected)
+        wav_path = manifest.outputs(path, 'convert', stage_params[0])
+        if wav_path is not None and os.path.exists(wav_path):
+            return 1, wav_path
+        return 0, path
+    return resume
+
+def corpus_on_stage(manifest: Manifest, stage_params: List[dict]):
+    """
+    Builds the pipeline_bounded on_stage hook: records each finished stage and saves the manifest,
+    so a crash loses at most the stages still running.
+    """
+    def on_stage(path, stage, result):
+        if stage == 0:
+            outputs = str(result)
+        elif stage == 1:
+            outputs = {'path': str(result.path), 'timestamps': [ts._asdict() for ts in result.timestamps]}
+        else:
+            outputs = result.dict(exclude={'segment_index'})
+            recorded = manifest.recorded_outputs(path, 'split')
+            if recorded is not None:
+                Manifest.remove_stale(split_outputs(Split(**recorded)), split_outputs(result))
+        manifest.mark_done(path, ('convert', 'detect', 'split')[stage], stage_params[stage], outputs)
+        manifest.save()
+    return on_stage
+
+async def iter_corpus(audio_directory,
+                      input_type: str = None,
+                      timestamp_merge_window: int = 1,
+                      max_in_flight: int = None,
+                      max_workers: int = None,
+                      manifest: Manifest = None) -> AsyncIterator[Split]:
+    """
+    Whole-corpus run: convert (skipped when input_type is None) -> detect -> clean & split,
+    pipelined across files with a bounded window. Yields each file's Split as it completes.
+    With a manifest, finished stages are skipped and each file resumes where it stopped;
+    a changed input or parameter re-runs that stage and everything after it.
+    Outputs go under the current directory of this process (the pool's workers keep their own).
+    """
+    t1_start = perf_counter()
+    stages = [partial(convert_stage, input_type=input_type, output_directory=os.getcwd()),
+              detect_stage,
+              partial(split_stage, timestamp_merge_window=timestamp_merge_window, output_root=os.getcwd())]
+    convert_params = {'input_type': input_type}
+    detect_params = {**convert_params, 'mode': 'memory'}
+    split_params = {**detect_params, 'timestamp_merge_window': timestamp_merge_window}
+    stage_params = [convert_params, detect_params, split_params]
+    resume = corpus_resume(manifest, stage_params) if manifest else None
+    on_stage = corpus_on_stage(manifest, stage_params) if manifest else None
+    audio_files = [os.path.abspath(path) for path in glob(audio_directory)]
+    async for result in pipeline_bounded(audio_files, stages, max_in_flight, max_workers,
+                                         resume=resume, on_stage=on_stage):
+        logger.info(f"Corpus pipeline completed for file: {result.input_path}")
+        yield result
+    t1_stop = perf_counter()
+    logger.info(f"Task complete! Elapsed time: {t1_stop - t1_start}")
+
+async def build_corpus(audio_directory, 
+                       input_type: str = None, 
+                       timestamp_merge_window: int = 1,
+                       manifest: Manifest = None) -> List[Split]:
+    return [result async for result in iter_corpus(audio_directory, input_type, timestamp_merge_window, 
+                                                   manifest=manifest)]
+
+def run_corpus(audio_directory = None, 
+               input_type: str = None, 
+               timestamp_merge_window: int = 1,
+               manifest_path: Path = None):
+    """
+    manifest_path: JSON manifest to resume from and keep up to date (no manifest when None).
+    """
+    manifest = Manifest.load(manifest_path) if manifest_path else None
+    return asyncio.run(build_corpus(audio_directory, input_type, timestamp_merge_window, manifest))
+
+if __name__ == '__main__':
+    run_corpus()
@@ -0,0 +1,155 @@
+from pydantic import BaseModel
+from pathlib import Path
+from typing import List, Any, Union, Callable
+from loguru import logger
+from time import perf_counter
+import os
+
+import asyncio
+from functools import partial
+from glob import glob
+
+from scheduler import map_bounded
+from manifest import Manifest
+from voice_audio_timestamps import VoiceDetect, DEFAULT_AGGRESSIVENESS
+from clean_timestamps import CleanTimestamps, Timestamps
+from split_by_timestamp import Split
+
+class FusedPipeline(BaseModel):
+    path: Path = None
+    raw_timestamps: List[Timestamps] = None
+    clean_timestamps: List[Timestamps] = None
+    output_paths: List[Path] = None
+
+    @staticmethod
+    def process(path: Path, 
+                output_directory: Path = None, 
+                timestamp_merge_window: int = 1,
+                aggressiveness: int = DEFAULT_AGGRESSIVENESS,
+                frame_duration_ms: int = 30,
+                container: bool = False,
+                raw_timestamps: List[dict] = None,
+                clean_timestamps: List[dict] = None,
+                energy_threshold: float = None,
+                channel: Union[int, str] = None) -> 'FusedPipeline':
+        """
+        Detect, clean and split one .wav, reading it from disk exactly once:
+        VAD, timestamp merging and segment export all work off the same decoded PCM buffer.
+        Segments go to output_directory (default: a directory named after the file),
+        either as one .wav per part or, with container=True, as one container file plus index.
+        raw_timestamps / clean_timestamps from an earlier run skip detection / cleaning.
+        energy_threshold turns on the VAD energy gate (see VoiceDetect.get_gated_voiced_frames).
+        Any .wav format is taken as is: VAD runs on a downmixed/resampled copy (channel as in
+        VoiceDetect.detect_source), while the parts are cut from the original full-fidelity PCM.
+        """
+        t1_start = perf_counter()
+        logger.info(f"Starting fused pipeline for: {path}")
+        filename = Path(path).stem
+        output_directory = Path(output_directory or filename)
+        os.makedirs(output_directory, exist_ok=True)
+        source = VoiceDetect.read_source(path)
+        if clean_timestamps is None:
+            if raw_timestamps is None:
+                speech_mask = VoiceDetect.detect_source(source, channel, aggressiveness, frame_duration_ms, energy_threshold)
+                raw_timestamps = [ts._asdict() for ts in VoiceDetect.get_timestamps(speech_mask, frame_duration_ms)]
+            detected = VoiceDetect(path=path, timestamps=raw_timestamps, frame_duration_ms=frame_duration_ms)
+            cleaned = CleanTimestamps.clean(detected, timestamp_merge_window)
+            clean_timestamps = [ts._asdict() for ts in cleaned.clean_timestamps]
+        output_paths = Split.write_pcm_segments(source.pcm_data, source.sample_rate, clean_timestamps, filename, 
+                                                output_directory, source.sample_width, source.num_channels, container)
+        data = {
+                'path': path,
+                'raw_timestamps': raw_timestamps,
+                'clean_timestamps': clean_timestamps,
+                'output_paths': output_paths
+                }
+        t1_stop = perf_counter()
+        logger.info(f"Done! Elapsed time: {t1_stop - t1_start}")
+        return FusedPipeline(**data)
+
+def stage_params(timestamp_merge_window: int = 1, 
+                 container: bool = False, 
+                 energy_threshold: float = None,
+                 channel: Union[int, str] = None) -> List[dict]:
+    """
+    Manifest params for the detect, clean and split stages; each includes the ones before it.
+    """
+    detect_params = {'aggressiveness': DEFAULT_AGGRESSIVENESS, 'frame_duration_ms': 30, 
+                     'energy_threshold': energy_threshold, 'channel': channel}
+    clean_params = {**detect_params, 'timestamp_merge_window': timestamp_merge_window}
+    split_params = {**clean_params, 'container': container}
+    return [detect_params, clean_params, split_params]
+
+async def build_pipeline(wav_directory, 
+                         timestamp_merge_window: int = 1, 
+                         max_workers = None,
+                         container: bool = False,
+                         manifest: Manifest = None,
+                         energy_threshold: float = None,
+                         channel: Union[int, str] = None,
+                         on_result: Callable[[FusedPipeline], None] = None) -> List[FusedPipeline]:
+    """
+    Runs the fused detect/clean/split stage for every .wav in the glob, one file per worker.
+    Only paths and timestamps cross the process boundary; audio never does.
+    With a manifest, files already split with the same params are not touched, files whose
+    detect/clean results are still valid only redo the stages after them, and the manifest
+    is saved after every file so an interrupted run picks up where it stopped.
+    on_result is called here with each file's result as soon as it's in (e.g. to queue its export).
+    """
+    t1_start = perf_counter()
+    detect_params, clean_params, split_params = stage_params(timestamp_merge_window, container, energy_threshold, channel)
+    results = []
+    calls = []
+    for wav in glob(wav_directory):
+        # the pool's workers keep the directory they were started in
+        wav = os.path.abspath(wav)
+        resumed = {}
+        if manifest:
+            manifest.refresh(wav)
+            split = manifest.outputs(wav, 'split', split_params)
+            if split is not None and all(os.path.exists(output_path) for output_path in split):
+                logger.info(f"Already split, skipping: {wav}")
+                result = FusedPipeline(path=wav,
+                                       raw_timestamps=manifest.outputs(wav, 'detect', detect_params),
+                                       clean_timestamps=manifest.outputs(wav, 'clean', clean_params),
+                                       output_paths=split)
+                if on_result:
+                    on_result(result)
+                results.append(result)
+                continue
+            resumed = {'raw_timestamps': manifest.outputs(wav, 'detect', detect_params),
+                       'clean_timestamps': manifest.outputs(wav, 'clean', clean_params)}
+        calls.append(partial(FusedPipeline.process, wav, 
+                             output_directory=os.path.abspath(Path(wav).stem),
+                             timestamp_merge_window=timestamp_merge_window, 
+                             container=container,
+                             energy_threshold=energy_threshold,
+                             channel=channel,
+                             **resumed))
+    async for result in map_bounded(calls, max_workers=max_workers):
+        logger.info(f"Pipeline completed for file: {result.path}, {len(result.clean_timestamps)} segments")
+        if manifest:
+            manifest.mark_done(result.path, 'detect', detect_params, [ts._asdict() for ts in result.raw_timestamps])
+            manifest.mark_done(result.path, 'clean', clean_params, [ts._asdict() for ts in result.clean_timestamps])
+            Manifest.remove_stale(manifest.recorded_outputs(result.path, 'split') or [], result.output_paths)
+            manifest.mark_done(result.path, 'split', split_params, [str(path) for path in result.output_paths])
+            manifest.save()
+        if on_result:
+            on_result(result)
+        results.append(result)
+    t1_stop = perf_counter()
+    logger.info(f"Task complete! Elapsed time: {t1_stop - t1_start}")
+    return results
+
+def run_pipeline(wav_directory = None, 
+                 timestamp_merge_window: int = 1, 
+                 container: bool = False, 
+                 manifest: Manifest = None,
+                 energy_threshold: float = None,
+                 channel: Union[int, str] = None,
+                 on_result: Callable[[FusedPipeline], None] = None):
+    return asyncio.run(build_pipeline(wav_directory, timestamp_merge_window, container=container, manifest=manifest,
+                                      energy_threshold=energy_threshold, channel=channel, on_result=on_result))
+
+if __name__ == '__main__':
+    run_pipeline()
@@ -0,0 +1,187 @@
+import os
+import json
+import time
+import asyncio
+import resource
+import functools
+import contextlib
+from pathlib import Path
+from typing import Dict, Any, Callable, Iterator, Tuple
+from loguru import logger
+
+# per-process stage totals: name -> {calls, wall_s, cpu_s, bytes_read, bytes_written, frames, max_wall_s}
+_stages: Dict[str, Dict[str, float]] = {}
+# peak RSS (KiB) per worker pid, filled in from the metrics tasks send back
+_workers: Dict[int, int] = {}
+# (output directory, 'cprofile' | 'pyinstrument') when profiling is on
+_profile: Tuple[str, str] = None
+_run_start = time.time()
+
+def record(name: str, wall: float, cpu: float = 0.0, **counters: float) -> None:
+    stats = _stages.setdefault(name, {'calls': 0, 'wall_s': 0.0, 'cpu_s': 0.0, 'max_wall_s': 0.0,
+                                      'bytes_read': 0, 'bytes_written': 0, 'frames': 0})
+    stats['calls'] += 1
+    stats['wall_s'] += wall
+    stats['cpu_s'] += cpu
+    stats['max_wall_s'] = max(stats['max_wall_s'], wall)
+    for key, value in counters.items():
+        stats[key] = stats.get(key, 0) + value
+
+def cpu_time() -> float:
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return time.process_time() + children.ru_utime + children.ru_stime
+
+@contextlib.contextmanager
+def measure(name: str) -> Iterator[Dict[str, float]]:
+    """
+    Times the block under a stage name: wall time, and CPU time of this process plus any
+    child processes it waited for (so ffmpeg's CPU counts too).
+    Yields a dict the block can put bytes_read / bytes_written / frames counts in.
+    """
+    counters = {}
+    wall_start, cpu_start = time.perf_counter(), cpu_time()
+    try:
+        yield counters
+    finally:
+        record(name, time.perf_counter() - wall_start, cpu_time() - cpu_start, **counters)
+
+def instrumented(name: str, counters: Callable[..., Dict[str, float]] = None) -> Callable:
+    """
+    Decorator version of measure. counters(result, *args, **kwargs) returns the byte/frame counts of a call.
+    Goes under @staticmethod.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with measure(name) as counts:
+                result = func(*args, **kwargs)
+                if counters is not None:
+                    counts.update(counters(result, *args, **kwargs))
+            return result
+        return wrapper
+    return decorator
+
+def file_size(path: Any) -> int:
+    with contextlib.suppress(OSError, TypeError):
+        return os.path.getsize(path)
+    return 0
+
+def peak_rss() -> int:
+    """
+    Peak resident set size of this process in KiB (Linux reports ru_maxrss in KiB).
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def drain() -> Dict[str, Any]:
+    """
+    Hands over and clears this process's stage totals, so a worker never reports the same work twice.
+    """
+    global _stages
+    stages, _stages = _stages, {}
+    return {'pid': os.getpid(), 'peak_rss_kb': peak_rss(), 'stages': stages}
+
+def merge(metrics: Dict[str, Any]) -> None:
+    for name, stats in metrics['stages'].items():
+        totals = _stages.setdefault(name, dict.fromkeys(stats, 0))
+        for key, value in stats.items():
+            totals[key] = max(totals.get(key, 0), value) if key == 'max_wall_s' else totals.get(key, 0) + value
+    _workers[metrics['pid']] = max(_workers.get(metrics['pid'], 0), metrics['peak_rss_kb'])
+
+def enable_profiling(output_directory: Path, backend: str = 'cprofile') -> None:
+    """
+    Profiles every pool task from now on (and whatever runs under profiled()), one file per task
+    in output_directory: .prof for cProfile (open with pstats/snakeviz), .html for pyinstrument.
+    """
+    global _profile
+    if backend not in ('cprofile', 'pyinstrument'):
+        raise ValueError(f"Unknown profiler: {backend}")
+    os.makedirs(output_directory, exist_ok=True)
+    _profile = (str(output_directory), backend)
+
+@contextlib.contextmanager
+def profiled(name: str, profile: Tuple[str, str] = None) -> Iterator[None]:
+    profile = profile or _profile
+    if profile is None:
+        yield
+        return
+    output_directory, backend = profile
+    output_path = os.path.join(output_directory, f"{name}-{os.getpid()}-{time.time_ns()}")
+    if backend == 'pyinstrument':
+        from pyinstrument import Profiler
+        profiler = Profiler()
+        profiler.start()
+        try:
+            yield
+        finally:
+            profiler.stop()
+            with open(output_path + '.html', 'w') as f:
+                f.write(profiler.output_html())
+    else:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            profiler.dump_stats(output_path + '.prof')
+
+def run_task(call: Callable[[], Any], submitted: float, profile: Tuple[str, str] = None) -> Tuple[Any, Dict[str, Any]]:
+    """
+    Worker side of run_in_pool: records how long the call sat in the pool queue, runs it
+    (under the profiler if asked) and sends the worker's metrics back with the result.
+    """
+    record('pool_queue_wait', time.time() - submitted)
+    name = getattr(getattr(call, 'func', call), '__qualname__', 'task')
+    with profiled(name, profile):
+        result = call()
+    return result, drain()
+
+async def run_in_pool(process_pool: Any, call: Callable[[], Any]) -> Any:
+    """
+    loop.run_in_executor for the shared pool that also collects the task's stage metrics.
+    """
+    loop = asyncio.get_running_loop()
+    result, metrics = await loop.run_in_executor(process_pool, functools.partial(run_task, call, time.time(), _profile))
+    merge(metrics)
+    return result
+
+def report() -> Dict[str, Any]:
+    """
+    Run report: totals per stage (across all workers), with frames/s and bytes/s where counted,
+    plus peak RSS of this process and of every worker that ran a task.
+    """
+    stages = {}
+    for name, stats in sorted(_stages.items()):
+        stages[name] = dict(stats)
+        if stats['wall_s'] > 0:
+            if stats.get('frames'):
+                stages[name]['frames_per_s'] = stats['frames'] / stats['wall_s']
+                if 'frames_skipped' in stats:
+                    stages[name]['skipped_fraction'] = stats['frames_skipped'] / stats['frames']
+            if stats.get('bytes_read'):
+                stages[name]['read_bytes_per_s'] = stats['bytes_read'] / stats['wall_s']
+            if stats.get('bytes_written'):
+                stages[name]['write_bytes_per_s'] = stats['bytes_written'] / stats['wall_s']
+    data = {
+            'started': _run_start,
+            'wall_s': time.time() - _run_start,
+            'cpu_s': time.process_time(),
+            'peak_rss_kb': peak_rss(),
+            'workers': {str(pid): {'peak_rss_kb': rss} for pid, rss in sorted(_workers.items())},
+            'stages': stages
+            }
+    return data
+
+def write_report(output_path: Path) -> Dict[str, Any]:
+    data = report()
+    with open(output_path, 'w') as f:
+        json.dump(data, f, indent=2)
+    logger.info(f"Run report written: {output_path}")
+    return data
+
+def reset() -> None:
+    global _run_start
+    _stages.clear()
+    _workers.clear()
+    _run_start = time.time()
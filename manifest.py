@@ -0,0 +1,105 @@
+import os
+import json
+from pydantic import BaseModel
+from pathlib import Path
+from typing import Dict, Any, Optional, Iterable
+from loguru import logger
+
+from vad_cache import VADCache
+
+class StageRecord(BaseModel):
+    params: str
+    outputs: Any = None
+
+class FileState(BaseModel):
+    mtime: float
+    size: int
+    sha256: str
+    stages: Dict[str, StageRecord] = {}
+
+class Manifest(BaseModel):
+    """
+    Per-file record of which pipeline stages are finished, saved as JSON next to the outputs.
+    A stage counts as done only if the input is unchanged (mtime/size, then content hash)
+    and it ran with the same parameters; stage params include their upstream stages' params,
+    so changing e.g. the merge window redoes clean and split but keeps detect.
+    """
+    path: Path
+    files: Dict[str, FileState] = {}
+
+    @staticmethod
+    def load(path: Path) -> 'Manifest':
+        if os.path.isfile(path):
+            with open(path) as f:
+                return Manifest(path=path, **json.load(f))
+        return Manifest(path=path)
+
+    def save(self) -> None:
+        tmp_path = str(self.path) + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'files': {name: state.dict() for name, state in self.files.items()}}, f, default=str)
+        os.replace(tmp_path, self.path) # a crash mid-write leaves the old manifest intact
+
+    @staticmethod
+    def params_key(params: Dict[str, Any]) -> str:
+        return json.dumps(params, sort_keys=True, default=str)
+
+    def refresh(self, input_path: Path) -> FileState:
+        """
+        Checks the input against what the manifest saw last time; forgets its stages if the content changed.
+        The content hash is only recomputed when mtime or size moved.
+        """
+        name = str(input_path)
+        stat = os.stat(input_path)
+        state = self.files.get(name)
+        if state is not None and (state.mtime, state.size) == (stat.st_mtime, stat.st_size):
+            return state
+        sha256 = VADCache.file_hash(input_path)
+        if state is None or state.sha256 != sha256:
+            if state is not None:
+                logger.info(f"Input changed, redoing all stages: {name}")
+            state = FileState(mtime=stat.st_mtime, size=stat.st_size, sha256=sha256)
+        else:
+            state.mtime, state.size = stat.st_mtime, stat.st_size
+        self.files[name] = state
+        return state
+
+    def outputs(self, input_path: Path, stage: str, params: Dict[str, Any]) -> Optional[Any]:
+        """
+        The recorded outputs of a finished stage, or None if it has to run (again).
+        """
+        state = self.files.get(str(input_path))
+        if state is None:
+            return None
+        record = state.stages.get(stage)
+        if record is None or record.params != self.params_key(params):
+            return None
+        return record.outputs
+
+    def recorded_outputs(self, input_path: Path, stage: str) -> Optional[Any]:
+        """
+        The outputs last recorded for a stage, whatever parameters it ran with.
+        """
+        state = self.files.get(str(input_path))
+        record = state.stages.get(stage) if state is not None else None
+        return record.outputs if record is not None else None
+
+    @staticmethod
+    def remove_stale(old_paths: Iterable[Path], new_paths: Iterable[Path]) -> int:
+        """
+        Deletes the files of a stage's previous run that its new run didn't write again
+        (e.g. parts 4 and up after a re-split into 3 parts). Returns how many were removed.
+        """
+        keep = {os.path.abspath(path) for path in new_paths}
+        removed = 0
+        for path in {os.path.abspath(path) for path in old_paths} - keep:
+            if os.path.isfile(path):
+                os.remove(path)
+                removed += 1
+        if removed:
+            logger.info(f"Removed {removed} stale outputs")
+        return removed
+
+    def mark_done(self, input_path: Path, stage: str, params: Dict[str, Any], outputs: Any = None) -> None:
+        state = self.files.get(str(input_path)) or self.refresh(input_path)
+        state.stages[stage] = StageRecord(params=self.params_key(params), outputs=outputs)
@@ -1,10 +1,13 @@
-from pydub import AudioSegment
 from pydantic import BaseModel
 from pathlib import Path
 from typing import List, Any
 from loguru import logger
-import regex as re
+import re
 from time import perf_counter
+import wave
+import contextlib
+
+from instrumentation import instrumented, file_size
 
 class MergeAudioItems(BaseModel):
     input_audio_paths: List[Path] = None
@@ -15,6 +18,7 @@ class MergeAudioItems(BaseModel):
         Merges files split by this tool together.
         Relies on filenames having _pt1.wav, _pt2.wav, etc as filename. 
         """
+        from pydub import AudioSegment
         t1_start = perf_counter()
         logger.info(f"Starting audio item merging!")
         audio_segments = AudioSegment.empty()
@@ -40,5 +44,42 @@ class MergeAudioItems(BaseModel):
             logger.info(f"Task complete! Elapsed time: {t1_stop - t1_start}")
             return MergeAudioItems(**data)
 
+    @instrumented('merge_stream', lambda result, *args, **kwargs: 
+                  {'bytes_written': file_size(result.output_audio_path) if result else 0})
+    def merge_stream(input_audio_paths: List[Path], block_frames: int = 2**16) -> 'MergeAudioItems':
+        """
+        Like merge, but streams: checks all parts share one wav format, writes a single header,
+        copies each part's PCM frames into the output block by block and patches the length
+        on close. Memory stays constant and time is linear in total size.
+        Same _pt1.wav, _pt2.wav, ... ordering and _merged output name as merge.
+        """
+        t1_start = perf_counter()
+        logger.info(f"Starting streaming audio item merging!")
+        input_audio_paths = [str(item) for item in input_audio_paths if re.search(r'_pt\d*\.wav', str(item)) != None]
+        if len(input_audio_paths) == 0:
+            logger.info('Nothing to merge! Needs _pt1.wav, _pt2.wav, etc files')
+            return None
+        input_audio_paths_sorted = sorted(input_audio_paths, key=lambda x: int(x.partition('_pt')[2].partition('.wav')[0]))
+        formats = set()
+        for item in input_audio_paths_sorted:
+            with contextlib.closing(wave.open(item, 'rb')) as wf:
+                formats.add((wf.getnchannels(), wf.getsampwidth(), wf.getframerate()))
+        if len(formats) > 1:
+            raise ValueError(f"Parts don't share one wav format (channels, sample width, rate): {formats}")
+        num_channels, sample_width, sample_rate = formats.pop()
+        merged_filename = re.sub(r'_pt\d*\.', '_merged.', input_audio_paths[0])
+        with wave.open(merged_filename, 'wb') as out:
+            out.setnchannels(num_channels)
+            out.setsampwidth(sample_width)
+            out.setframerate(sample_rate)
+            for item in input_audio_paths_sorted:
+                with contextlib.closing(wave.open(item, 'rb')) as wf:
+                    for block in iter(lambda: wf.readframes(block_frames), b''):
+                        out.writeframesraw(block)
+        data = {'input_audio_paths': input_audio_paths_sorted, 'output_audio_path': merged_filename}
+        t1_stop = perf_counter()
+        logger.info(f"Task complete! Elapsed time: {t1_stop - t1_start}")
+        return MergeAudioItems(**data)
+
 if __name__ == '__main__':
     MergeAudioItems.merge()
\ No newline at end of file
@@ -0,0 +1,127 @@
+import numpy as np
+from typing import Any, Union
+
+# rates webrtcvad takes; anything else is resampled to VAD_FALLBACK_RATE (8 kHz if the source is below it)
+VAD_SAMPLE_RATES = (8000, 16000, 32000, 48000)
+VAD_FALLBACK_RATE = 16000
+
+def vad_sample_rate(sample_rate: int) -> int:
+    if sample_rate in VAD_SAMPLE_RATES:
+        return sample_rate
+    return VAD_FALLBACK_RATE if sample_rate >= VAD_FALLBACK_RATE else 8000
+
+def resampled_length(num_samples: int, sample_rate: int, output_rate: int) -> int:
+    """
+    How many samples Resampler puts out for num_samples input samples.
+    """
+    if num_samples <= 0:
+        return 0
+    return (num_samples - 1) * output_rate // sample_rate + 1
+
+def decode_samples(pcm_data: Any, sample_width: int, num_channels: int) -> np.ndarray:
+    """
+    PCM bytes of any wav sample width (8-bit unsigned, 16/24/32-bit signed) to float32,
+    shaped (frames, channels), on a 16-bit scale.
+    """
+    if sample_width == 1:
+        samples = (np.frombuffer(pcm_data, dtype=np.uint8).astype(np.float32) - 128) * 256
+    elif sample_width == 2:
+        samples = np.frombuffer(pcm_data, dtype='<i2').astype(np.float32)
+    elif sample_width == 3:
+        raw = np.frombuffer(pcm_data, dtype=np.uint8).reshape(-1, 3).astype(np.int32)
+        samples = ((raw[:, 0] << 8 | raw[:, 1] << 16 | raw[:, 2] << 24) >> 8).astype(np.float32) / 256
+    elif sample_width == 4:
+        samples = np.frombuffer(pcm_data, dtype='<i4').astype(np.float32) / 65536
+    else:
+        raise ValueError(f"Unsupported sample width: {sample_width} bytes")
+    return samples.reshape(-1, num_channels)
+
+class Resampler:
+    """
+    Streaming linear-interpolation resampler. Output sample k sits at input position
+    k * sample_rate / output_rate; the input samples still needed for the next block are
+    carried over, so feeding a signal in blocks gives the same output as feeding it whole.
+    start_output skips ahead: input then starts at input sample first_input(start_output).
+    (No anti-alias filter: this only feeds VAD, which band-limits to speech anyway.)
+    """
+    def __init__(self, sample_rate: int, output_rate: int, start_output: int = 0):
+        self.sample_rate = sample_rate
+        self.output_rate = output_rate
+        self.next_output = start_output
+        self.tail_offset = self.first_input(start_output)
+        self.tail = np.empty(0, dtype=np.float32)
+
+    def first_input(self, output_sample: int) -> int:
+        """
+        First input sample that output sample output_sample depends on.
+        """
+        return output_sample * self.sample_rate // self.output_rate
+
+    def process(self, samples: np.ndarray) -> np.ndarray:
+        samples = np.concatenate([self.tail, samples])
+        last_output = resampled_length(self.tail_offset + len(samples), self.sample_rate, self.output_rate)
+        positions = np.arange(self.next_output, last_output, dtype=np.float64) * self.sample_rate / self.output_rate
+        output = np.interp(positions - self.tail_offset, np.arange(len(samples)), samples).astype(np.float32)
+        self.next_output = last_output
+        keep_from = min(self.next_output * self.sample_rate // self.output_rate, self.tail_offset + len(samples))
+        self.tail = samples[keep_from - self.tail_offset:]
+        self.tail_offset = keep_from
+        return output
+
+class VADConverter:
+    """
+    Turns PCM of any wav format into what webrtcvad takes (16-bit mono at a supported rate),
+    block by block. channel=None averages the channels; an int keeps only that channel.
+    Blocks must hold whole frames. Input that already fits is passed through untouched (no copy).
+    """
+    def __init__(self, sample_rate: int, sample_width: int = 2, num_channels: int = 1, channel: Union[int, None] = None):
+        if sample_width not in (1, 2, 3, 4):
+            raise ValueError(f"Unsupported sample width: {sample_width} bytes")
+        if channel is not None and not 0 <= channel < num_channels:
+            raise ValueError(f"No channel {channel} in {num_channels}-channel audio")
+        self.sample_rate = sample_rate
+        self.sample_width = sample_width
+        self.num_channels = num_channels
+        self.channel = channel
+        self.vad_rate = vad_sample_rate(sample_rate)
+        self.passthrough = sample_width == 2 and num_channels == 1 and sample_rate == self.vad_rate
+        self.resampler = Resampler(sample_rate, self.vad_rate) if sample_rate != self.vad_rate else None
+
+    def vad_length(self, num_frames: int) -> int:
+        """
+        Bytes of VAD PCM the whole of a num_frames-frame source converts to.
+        """
+        if self.resampler is None:
+            return num_frames * 2
+        return resampled_length(num_frames, self.sample_rate, self.vad_rate) * 2
+
+    def convert(self, pcm_data: Any, resampler: Resampler = None) -> Any:
+        if self.passthrough:
+            return pcm_data
+        samples = decode_samples(pcm_data, self.sample_width, self.num_channels)
+        if self.channel is None:
+            samples = samples.mean(axis=1) if self.num_channels > 1 else samples[:, 0]
+        else:
+            samples = samples[:, self.channel]
+        resampler = resampler or self.resampler
+        if resampler is not None:
+            samples = resampler.process(samples)
+        return np.clip(np.rint(samples), -32768, 32767).astype('<i2').tobytes()
+
+    def convert_range(self, pcm_data: Any, first_sample: int, last_sample: int) -> Any:
+        """
+        VAD samples first_sample..last_sample of the whole source pcm_data, converting only the
+        source frames they depend on. Gives the same bytes as that slice of convert(pcm_data).
+        """
+        frame_width = self.sample_width * self.num_channels
+        num_frames = len(pcm_data) // frame_width
+        if self.resampler is None:
+            first_input, last_input, resampler = first_sample, last_sample, None
+        else:
+            resampler = Resampler(self.sample_rate, self.vad_rate, first_sample)
+            first_input = resampler.first_input(first_sample)
+            # each output sample interpolates between two input samples
+            last_input = resampler.first_input(last_sample - 1) + 2 if last_sample > first_sample else first_input
+        last_input = min(last_input, num_frames)
+        vad_pcm = self.convert(pcm_data[first_input * frame_width:last_input * frame_width], resampler)
+        return vad_pcm[:(last_sample - first_sample) * 2]
@@ -5,14 +5,14 @@ if __name__ == "__main__":
     from pathlib import Path
     import json
     from loguru import logger
-    import shutil
     from glob import glob
     from time import perf_counter
 
     from convert_audio import run_convert
-    from voice_audio_timestamps import run_voice_detection
-    from clean_timestamps import CleanTimestamps
-    from split_by_timestamp import run_split
+    from fused_pipeline import run_pipeline, stage_params
+    from manifest import Manifest
+    from instrumentation import write_report, enable_profiling
+    from timestamp_export import TimestampExporter
     from merge_audio_items import MergeAudioItems
 
     t1_start = perf_counter()
@@ -24,36 +24,40 @@ if __name__ == "__main__":
     # Convert audio to wav for voice detection
     # audio_items = run_convert(r'/Users/andrewkirby/Documents/summa_linguae/WER_test/Test files_Hindi/*.mp3', 'wav')
 
-    # Detect voice and output timestamps from wav file
-    wav_paths = r'/Users/andrewkirby/Documents/summa_linguae/WER_test/Test files_Eng/*_1channel.wav'
-    ts_items = run_voice_detection(wav_paths)
+    # Detect voice, clean up timestamps and split audio by timestamp;
+    # each wav is read once and its parts are packed into one segment archive
+    # (<name>_segments.wav + .idx, read with segment_archive.SegmentArchive) in a directory named after it
+    # Uncomment to profile every pool task (cProfile .prof files; backend='pyinstrument' for HTML)
+    # enable_profiling('profiles')
 
-    # clean up timestamps
-    ts_items_clean = [CleanTimestamps.clean(ts_item) for ts_item in ts_items]
+    # manifest.json records what's finished, so a rerun only processes new or changed files
+    manifest = Manifest.load('manifest.json')
+    # any .wav works (stereo, 44.1 kHz, 24-bit...): VAD downmixes/resamples in-process and parts are cut from the original
+    wav_paths = r'/Users/andrewkirby/Documents/summa_linguae/WER_test/Test files_Eng/*.wav'
 
-    # Split audio by timestamp; export timestamps to JSON
-    for items in ts_items_clean:
+    # Export timestamps to JSON: <name>/<name>.jsonl per source, written on a background thread
+    # as each file finishes, while the next ones are still being detected.
+    # Header line {"filename": "<name>_segments.wav", "fields": ["part", "start", "stop"]}, then [part, start, stop] lines;
+    # layout='columns' writes one {"filename", "start": [...], "stop": [...]} line instead.
+    # NOTE: transcripts (vtt) can go in a separate file keyed by part
+    export_params = {**stage_params(container=True)[-1], 'layout': 'rows'}
+
+    def export_timestamps(items):
         item_output_dirname = (Path(items.path)).stem
-        if not os.path.isdir(item_output_dirname):
-            os.makedirs(item_output_dirname)
-        
-        out_path = item_output_dirname + r'.jsonl'
-        with open(out_path, 'w') as fout:
-            fname_counter = 1
-            for ts in items.clean_timestamps:
-                ts_dict = ts.dict()
-                ts_dict['filename'] = item_output_dirname + '_split_pt' + str(fname_counter) + '.wav'
-                # NOTE: put vtt stuff here:
-                ts_dict['vtt'] = 'Voice text from Assembly'
-                fout.write(json.dumps(ts_dict) + '\n')
-                fname_counter += 1
-        fname_counter = 0
-        logger.info(f"JSON exported: {out_path}")
-        ts_d = [item.dict() for item in items.clean_timestamps]
-        split_items = run_split(items.path, ts_d)
-        for f in glob(str(item_output_dirname) + '*'):
-            shutil.move(f, item_output_dirname) 
+        out_path = os.path.join(item_output_dirname, item_output_dirname + r'.jsonl')
+        if manifest.outputs(items.path, 'export', export_params) == out_path and os.path.exists(out_path):
+            return
+        exporter.submit(out_path, item_output_dirname + '_segments.wav', items.clean_timestamps, source=items.path)
+
+    with TimestampExporter(layout=export_params['layout']) as exporter:
+        items_split = run_pipeline(wav_paths, container=True, manifest=manifest, on_result=export_timestamps)
+    for source, out_path in exporter.written:
+        manifest.mark_done(source, 'export', export_params, out_path)
+    manifest.save()
     
+    # Per-stage timings, bytes, frames/s, pool queue wait and worker peak RSS
+    write_report('run_report.json')
+
     # Set terminal directory back to above output:
     path_parent = os.path.dirname(os.getcwd())
     os.chdir(path_parent)
@@ -71,11 +75,9 @@ if __name__ == "__main__":
 
     # Cut large audio files into pieces
     # from clip_and_export_audio import run_clips
-    # from glob import glob
 
     # directory = r'/Users/andrewkirby/Documents/summa_linguae/split_for_subham/*.mp3'
-    # for path in glob(directory):
-    #     run_clips(path)
+    # run_clips(directory)
 
     # send timestamps to sample json
     # import json
@@ -0,0 +1,73 @@
+from typing import List, Any, Callable, Iterable, AsyncIterator, Tuple
+
+import asyncio
+from functools import partial
+
+from worker_pool import get_process_pool, pool_size
+from instrumentation import run_in_pool
+
+async def as_completed_bounded(jobs: Iterable[Callable[[], Any]],
+                               max_in_flight: int = None) -> AsyncIterator[Any]:
+    """
+    Runs jobs with at most max_in_flight started at once, and yields each result as soon as it's done.
+    A job is a zero-argument callable returning an awaitable; jobs are pulled from the iterable
+    only when there is room, so a huge corpus is never submitted (or held) all at once.
+    The first failure cancels whatever is still pending and is raised to the caller.
+    Default window is two jobs per pool worker.
+    """
+    max_in_flight = max_in_flight or pool_size() * 2
+    jobs = iter(jobs)
+    pending = set()
+    try:
+        while True:
+            for job in jobs:
+                pending.add(asyncio.ensure_future(job()))
+                if len(pending) >= max_in_flight:
+                    break
+            if not pending:
+                return
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+    finally:
+        for future in pending:
+            future.cancel()
+
+async def map_bounded(calls: Iterable[Callable[[], Any]],
+                      max_in_flight: int = None,
+                      max_workers: int = None) -> AsyncIterator[Any]:
+    """
+    as_completed_bounded for plain picklable calls: each one runs in the shared process pool.
+    """
+    process_pool = get_process_pool(max_workers)
+    jobs = (partial(run_in_pool, process_pool, call) for call in calls)
+    async for result in as_completed_bounded(jobs, max_in_flight):
+        yield result
+
+async def pipeline_bounded(items: Iterable[Any],
+                           stages: List[Callable[[Any], Any]],
+                           max_in_flight: int = None,
+                           max_workers: int = None,
+                           resume: Callable[[Any], Tuple[int, Any]] = None,
+                           on_stage: Callable[[Any, int, Any], None] = None) -> AsyncIterator[Any]:
+    """
+    Passes each item through the stages in order, every stage call running in the shared process pool.
+    Items move through independently, so stage 1 of item N+1 overlaps stage 2 of item N and
+    stage 3 of item N-1. At most max_in_flight items are between first and last stage at once.
+    Yields the last stage's result for each item as it finishes.
+    resume(item) may return (stage index, value) to start an item part way through, e.g. from a manifest;
+    on_stage(item, stage index, result) is called in this process after every stage that ran.
+    """
+    process_pool = get_process_pool(max_workers)
+
+    async def run_stages(item):
+        first, value = resume(item) if resume else (0, item)
+        for i, stage in enumerate(stages[first:], first):
+            value = await run_in_pool(process_pool, partial(stage, value))
+            if on_stage:
+                on_stage(item, i, value)
+        return value
+
+    jobs = (partial(run_stages, item) for item in items)
+    async for result in as_completed_bounded(jobs, max_in_flight):
+        yield result
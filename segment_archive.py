@@ -0,0 +1,136 @@
+import os
+import mmap
+import wave
+import struct
+import numpy as np
+from pathlib import Path
+from typing import Any, NamedTuple, Tuple, Union
+from functools import lru_cache
+
+# <stem>_segments.wav holds every segment of a source back to back (still a playable wav);
+# <stem>_segments.idx is a fixed-size header followed by one fixed-size record per segment,
+# so segment i is found with one seek, without reading anything else.
+INDEX_MAGIC = b'SNSI'
+INDEX_VERSION = 1
+# magic, version, sample_rate, sample_width, num_channels, segment count, byte offset of PCM in the .wav
+INDEX_HEADER = struct.Struct('<4sHIHHIQ')
+# offset (frames into the container), frames, padding frames, source start/stop sample, start/stop seconds
+INDEX_RECORD = struct.Struct('<QIIQQdd')
+
+@lru_cache(maxsize=None)
+def zero_padding(num_bytes: int) -> bytes:
+    """
+    One zero buffer per size, allocated once and shared by every padded segment.
+    """
+    return bytes(num_bytes)
+
+def archive_paths(path: Union[Path, str]) -> Tuple[Path, Path]:
+    """
+    (container .wav, index .idx) for an archive given by either file or their common stem.
+    """
+    stem = str(path)
+    if stem.endswith(('.wav', '.idx')):
+        stem = stem[:-4]
+    return Path(stem + '.wav'), Path(stem + '.idx')
+
+class SegmentInfo(NamedTuple):
+    part: int
+    offset: int
+    frames: int
+    padding: int
+    source_start: int
+    source_stop: int
+    start: float
+    stop: float
+
+class SegmentArchive:
+    """
+    Random-access reader for a segment archive. Opens the container with mmap when it can,
+    so audio(i) hands back a zero-copy view; falls back to positional reads otherwise.
+    Use as a context manager.
+    """
+    def __init__(self, path: Union[Path, str]):
+        self.wav_path, self.index_path = archive_paths(path)
+        self._index = open(self.index_path, 'rb')
+        magic, version, self.sample_rate, self.sample_width, self.num_channels, self.count, self.data_offset = \
+            INDEX_HEADER.unpack(self._index.read(INDEX_HEADER.size))
+        if magic != INDEX_MAGIC or version != INDEX_VERSION:
+            raise ValueError(f"Not a segment archive index: {self.index_path}")
+        self.frame_width = self.sample_width * self.num_channels
+        self._wav = open(self.wav_path, 'rb')
+        try:
+            self._mmap = mmap.mmap(self._wav.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, OSError):
+            self._mmap = None
+
+    def __len__(self) -> int:
+        return self.count
+
+    def __enter__(self) -> 'SegmentArchive':
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def close(self) -> None:
+        if self._mmap is not None:
+            self._mmap.close()
+        self._wav.close()
+        self._index.close()
+
+    def segment(self, i: int) -> SegmentInfo:
+        if not 0 <= i < self.count:
+            raise IndexError(f"Segment {i} out of range; archive has {self.count}")
+        record = os.pread(self._index.fileno(), INDEX_RECORD.size, INDEX_HEADER.size + i * INDEX_RECORD.size)
+        return SegmentInfo(i + 1, *INDEX_RECORD.unpack(record))
+
+    def audio(self, i: int) -> Any:
+        """
+        PCM of segment i (padding included): a memoryview over the mapped file, or bytes without mmap.
+        Release/drop the view before closing the archive.
+        """
+        info = self.segment(i)
+        start = self.data_offset + info.offset * self.frame_width
+        length = info.frames * self.frame_width
+        if self._mmap is not None:
+            return memoryview(self._mmap)[start:start + length]
+        return os.pread(self._wav.fileno(), length, start)
+
+    @staticmethod
+    def write(pcm_data: Any,
+              sample_rate: int,
+              segment_index: np.ndarray,
+              output_path: Union[Path, str],
+              sample_width: int = 2,
+              num_channels: int = 1) -> Tuple[Path, Path]:
+        """
+        Writes the archive in one sequential pass: every (start_sample, stop_sample) range of
+        pcm_data goes into <output_path>.wav back to back (parts under a second get a second of
+        silence in front, as with split files), then the index goes to <output_path>.idx.
+        Returns both paths (see archive_paths).
+        """
+        wav_path, index_path = archive_paths(output_path)
+        frame_width = sample_width * num_channels
+        pcm_data = memoryview(pcm_data)
+        silence = zero_padding(sample_rate * frame_width)
+        records = []
+        offset = 0
+        with open(wav_path, 'wb') as f, wave.open(f, 'wb') as wf:
+            wf.setnchannels(num_channels)
+            wf.setsampwidth(sample_width)
+            wf.setframerate(sample_rate)
+            wf.writeframesraw(b'') # writes the header, so the PCM offset is known
+            data_offset = f.tell()
+            for start, stop in segment_index.tolist():
+                padding = sample_rate if stop - start < sample_rate else 0
+                if padding:
+                    wf.writeframesraw(silence)
+                wf.writeframesraw(pcm_data[start * frame_width:stop * frame_width])
+                records.append(INDEX_RECORD.pack(offset, padding + stop - start, padding, start, stop,
+                                                 start / sample_rate, stop / sample_rate))
+                offset += padding + stop - start
+        with open(index_path, 'wb') as f:
+            f.write(INDEX_HEADER.pack(INDEX_MAGIC, INDEX_VERSION, sample_rate, sample_width, num_channels,
+                                      len(records), data_offset))
+            f.write(b''.join(records))
+        return wav_path, index_path
@@ -1,6 +1,5 @@
 from pydantic import BaseModel
-from pydub import AudioSegment
-from typing import List, Any, Tuple
+from typing import List, Any, Tuple, NamedTuple
 from pathlib import Path
 
 from loguru import logger
@@ -8,35 +7,49 @@ from time import perf_counter
 
 import asyncio
 from functools import partial
-from asyncio.events import AbstractEventLoop
-from concurrent.futures import ProcessPoolExecutor
 
-class Timestamps(BaseModel):
-    start: float
-    stop: float
+import os
+import wave
+import contextlib
+import numpy as np
+
+from worker_pool import get_process_pool, pool_size
+from segment_archive import SegmentArchive, zero_padding
+from instrumentation import instrumented, run_in_pool, file_size
+from clean_timestamps import Timestamps
+
+class SplitPart(NamedTuple):
+    output_path: str
+    # an AudioSegment (by_timestamp) or (start_ms, stop_ms) (get_ranges)
+    part: Any
 
 class Split(BaseModel):
     timestamps: List[Timestamps] = None
     input_path: Path = None
-    output_paths_and_parts: List[Tuple[Path, Any]] = None
+    output_paths_and_parts: List[SplitPart] = None
+    # (start_sample, stop_sample) per part, see sample_offsets
+    segment_index: Any = None
 
     @staticmethod
+    @instrumented('export_audio', lambda result, *args, **kwargs: {'bytes_written': file_size(result)})
     def export_audio(output_filename: Path, audio_segment: Any) -> Path:
         # if Path(output_filename).suffix == 'wav':
         audio_segment.export(output_filename, format='wav')
         return output_filename
 
+    @instrumented('by_timestamp', lambda result, input_path, *args, **kwargs: {'bytes_read': file_size(input_path)})
     def by_timestamp(input_path: Path, timestamps: List[Timestamps]) -> 'Split':
+        from pydub import AudioSegment
         part_number = 1
         filename = Path(input_path).stem
         audio_segment = AudioSegment.from_wav(input_path)
         output_paths_and_parts = []
         for ts in timestamps:
             audio_part = audio_segment[ts['start'] * 1000 : ts['stop'] * 1000]
-            if ts['stop'] - ts['start'] < 1000:
+            if ts['stop'] - ts['start'] < 1: # timestamps are in seconds
                 audio_part = AudioSegment.silent(duration=1000) + audio_part
             output_path = filename + '_split_pt' + str(part_number) + '.wav'
-            output_paths_and_parts.append((output_path, audio_part))
+            output_paths_and_parts.append(SplitPart(output_path, audio_part))
             part_number += 1
         data = {
                 'timestamps': timestamps,
@@ -45,34 +58,158 @@ class Split(BaseModel):
                 }
         return Split(**data)
 
+    def get_ranges(input_path: Path, timestamps: List[Timestamps]) -> 'Split':
+        """
+        Like by_timestamp, but without decoding anything: each part is (output path, (start_ms, stop_ms)).
+        Everything is built with the right types here, so the model skips validating it part by part.
+        """
+        filename = Path(input_path).stem
+        output_paths_and_ranges = []
+        for part_number, ts in enumerate(timestamps, start=1):
+            output_path = filename + '_split_pt' + str(part_number) + '.wav'
+            output_paths_and_ranges.append(SplitPart(output_path, (round(ts['start'] * 1000), round(ts['stop'] * 1000))))
+        data = {
+                'timestamps': [Timestamps(ts['start'], ts['stop']) for ts in timestamps],
+                'input_path': Path(input_path),
+                'output_paths_and_parts': output_paths_and_ranges
+                }
+        return Split.construct(**data)
+
+    @staticmethod
+    @instrumented('export_ranges', lambda result, *args, **kwargs: {'bytes_written': sum(map(file_size, result))})
+    def export_ranges(input_path: Path, output_paths_and_ranges: List[Tuple[Path, Tuple[int, int]]]) -> List[Path]:
+        """
+        Reads only the start_ms-stop_ms frames of the source .wav for each part and writes them out.
+        Meant for pool workers: just a path and ints get pickled, never audio.
+        The source is opened once per batch of parts.
+        """
+        output_paths = []
+        with contextlib.closing(wave.open(str(input_path), 'rb')) as wf:
+            params = wf.getparams()
+            silence = zero_padding(params.framerate * params.sampwidth * params.nchannels)
+            for output_filename, (start_ms, stop_ms) in output_paths_and_ranges:
+                start = min(round(start_ms * params.framerate / 1000), params.nframes)
+                stop = min(round(stop_ms * params.framerate / 1000), params.nframes)
+                wf.setpos(start)
+                audio = wf.readframes(max(stop - start, 0))
+                with wave.open(str(output_filename), 'wb') as out:
+                    out.setnchannels(params.nchannels)
+                    out.setsampwidth(params.sampwidth)
+                    out.setframerate(params.framerate)
+                    if stop_ms - start_ms < 1000:
+                        out.writeframes(silence)
+                    out.writeframes(audio)
+                output_paths.append(output_filename)
+        return output_paths
+
+    @staticmethod
+    def sample_offsets(timestamps: List[Timestamps], sample_rate: int) -> np.ndarray:
+        """
+        Computes (start_sample, stop_sample) for every timestamp in one go.
+        Timestamps sit on VAD frame boundaries, so rounding lands exactly on a frame's first sample.
+        """
+        times = np.array([(ts['start'], ts['stop']) for ts in timestamps], dtype=np.float64).reshape(-1, 2)
+        return np.rint(times * sample_rate).astype(np.int64)
+
+    @staticmethod
+    @instrumented('write_pcm_segments', lambda result, *args, **kwargs: {'bytes_written': sum(map(file_size, result))})
+    def write_pcm_segments(pcm_data: Any, 
+                           sample_rate: int, 
+                           timestamps: List[Timestamps], 
+                           filename: str,
+                           output_directory: Path = '.',
+                           sample_width: int = 2,
+                           num_channels: int = 1,
+                           container: bool = False) -> List[Path]:
+        """
+        Writes each timestamped segment straight from an already-decoded PCM buffer with the wave writer,
+        so the source doesn't need to be decoded again. Same naming and padding as by_timestamp.
+        Segments are byte ranges at exact sample offsets; parts under a second get a second of
+        silence in front, from one shared zero buffer.
+        With container=True, writes a single segment archive instead (see write_container).
+        """
+        segment_index = Split.sample_offsets(timestamps, sample_rate)
+        if container:
+            return list(Split.write_container(pcm_data, sample_rate, segment_index, filename, output_directory, 
+                                              sample_width, num_channels))
+        frame_width = sample_width * num_channels
+        pcm_data = memoryview(pcm_data)
+        silence = zero_padding(sample_rate * frame_width)
+        output_paths = []
+        for part_number, (start, stop) in enumerate(segment_index.tolist(), start=1):
+            output_path = Path(output_directory) / (filename + '_split_pt' + str(part_number) + '.wav')
+            with wave.open(str(output_path), 'wb') as wf:
+                wf.setnchannels(num_channels)
+                wf.setsampwidth(sample_width)
+                wf.setframerate(sample_rate)
+                if stop - start < sample_rate:
+                    wf.writeframes(silence)
+                wf.writeframes(pcm_data[start * frame_width:stop * frame_width])
+            output_paths.append(output_path)
+        return output_paths
+
+    @staticmethod
+    def write_container(pcm_data: Any,
+                        sample_rate: int,
+                        segment_index: np.ndarray,
+                        filename: str,
+                        output_directory: Path = '.',
+                        sample_width: int = 2,
+                        num_channels: int = 1) -> Tuple[Path, Path]:
+        """
+        Writes all segments back to back into one <filename>_segments.wav with a
+        <filename>_segments.idx offset index (see segment_archive), instead of thousands of tiny files.
+        Returns (.wav, .idx), so both count as outputs.
+        """
+        return SegmentArchive.write(pcm_data, sample_rate, segment_index, 
+                                    Path(output_directory) / (filename + '_segments'), sample_width, num_channels)
+
 async def build_split(input_path: Path, 
                       timestamps: List[Timestamps],
-                      max_workers = 8) -> Split:
+                      max_workers = None,
+                      mode = 'ranges') -> Split:
     """
     Prepares partitions of audio clips by timestamp and outputs to current directory.
     For each partition, adds a _pt1, _pt2, etc to each output filename.
+    Mode can be: ranges (workers get (path, start_ms, stop_ms) and read their own part of the source)
+    or segments (parts are sliced here and pickled to the workers)
+    Paths are made absolute here: the shared pool's workers keep the directory they were started in.
     """
     t1_start = perf_counter()
     logger.info(f"Starting splitting by timestamp!")
-    data = Split.by_timestamp(input_path, timestamps)
+    input_path = os.path.abspath(input_path)
+    if mode == 'segments':
+        data = Split.by_timestamp(input_path, timestamps)
+    else:
+        data = Split.get_ranges(input_path, timestamps)
     if data:
+        data.output_paths_and_parts = [SplitPart(os.path.abspath(output_path), part) 
+                                       for output_path, part in data.output_paths_and_parts]
         parts = data.output_paths_and_parts
-        with ProcessPoolExecutor(max_workers) as process_pool:
-            loop: AbstractEventLoop = asyncio.get_running_loop()
+        process_pool = get_process_pool(max_workers)
+        if mode == 'segments':
             calls: List[partial[int]] = [partial(Split.export_audio, part[0], part[1]) for part in parts]
-            call_coros = []
-            for call in calls: call_coros.append(loop.run_in_executor(process_pool, call))
-            results = await asyncio.gather(*call_coros)
-            for result in results:
-                logger.info(f"Export completed for file: {result}")
+        else:
+            # a few batches per worker, so each task opens the source once for many parts
+            batch_size = max(1, -(-len(parts) // (pool_size() * 4)))
+            calls: List[partial[int]] = [partial(Split.export_ranges, input_path, parts[i:i + batch_size]) 
+                                         for i in range(0, len(parts), batch_size)]
+        call_coros = []
+        for call in calls: call_coros.append(run_in_pool(process_pool, call))
+        results = await asyncio.gather(*call_coros)
+        if mode != 'segments':
+            results = [output_path for batch in results for output_path in batch]
+        for result in results:
+            logger.info(f"Export completed for file: {result}")
         t1_stop = perf_counter()
         logger.info(f"Task complete! Elapsed time: {t1_stop - t1_start}")
         return data
     else: pass
 
 def run_split(input_path: Path, 
-              timestamps: List[Timestamps]):
-    return asyncio.run(build_split(input_path, timestamps))
+              timestamps: List[Timestamps],
+              mode = 'ranges'):
+    return asyncio.run(build_split(input_path, timestamps, mode=mode))
 
 if __name__ == '__main__':
     run_split()
\ No newline at end of file
@@ -0,0 +1,97 @@
+import json
+import queue
+import threading
+from pathlib import Path
+from typing import List, Any, Tuple
+from loguru import logger
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+def json_dumps(backend: str = 'auto'):
+    """
+    Returns a record -> bytes serializer: orjson when asked for (or on 'auto' when it's installed), else json.
+    """
+    if backend == 'orjson' or (backend == 'auto' and orjson is not None):
+        if orjson is None:
+            raise ImportError("backend='orjson' needs the orjson package")
+        return orjson.dumps
+    if backend not in ('auto', 'json'):
+        raise ValueError(f"Unknown JSON backend: {backend}")
+    return lambda record: json.dumps(record, separators=(',', ':')).encode()
+
+def start_stop(ts: Any) -> Tuple[float, float]:
+    if isinstance(ts, dict):
+        return ts['start'], ts['stop']
+    return ts.start, ts.stop
+
+class TimestampExporter:
+    """
+    Writes timestamp JSONL files on a background thread, fed by a bounded queue, so export
+    I/O overlaps detection of the next file. Each file is serialized in full and written in one call.
+    Layouts:
+    rows: a {"filename": ..., "fields": ["part", "start", "stop"]} header, then one [part, start, stop] line per segment
+    columns: a single {"filename": ..., "start": [...], "stop": [...]} line; part n is index n - 1
+    Use as a context manager; leaving it waits for the queue to drain and raises the first write error.
+    """
+    def __init__(self, layout: str = 'rows', backend: str = 'auto', max_queued: int = 64):
+        if layout not in ('rows', 'columns'):
+            raise ValueError(f"Unknown layout: {layout}")
+        self.layout = layout
+        self.dumps = json_dumps(backend)
+        self.queue = queue.Queue(max_queued)
+        # (source, output path) of every file written so far
+        self.written: List[Tuple[Any, Path]] = []
+        self.error: BaseException = None
+        self.thread = threading.Thread(target=self.writer, name='timestamp-export', daemon=True)
+        self.thread.start()
+
+    def __enter__(self) -> 'TimestampExporter':
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def encode(self, filename: str, timestamps: List[Any]) -> bytes:
+        times = [start_stop(ts) for ts in timestamps]
+        if self.layout == 'columns':
+            record = {'filename': filename, 'start': [start for start, _ in times], 'stop': [stop for _, stop in times]}
+            return self.dumps(record) + b'\n'
+        lines = [self.dumps({'filename': filename, 'fields': ['part', 'start', 'stop']})]
+        lines += [self.dumps([part, start, stop]) for part, (start, stop) in enumerate(times, start=1)]
+        return b'\n'.join(lines) + b'\n'
+
+    def submit(self, output_path: Path, filename: str, timestamps: List[Any], source: Any = None) -> None:
+        """
+        Queues one file's timestamps for writing; blocks only while the queue is full.
+        filename is the audio the parts live in, stored once per file; source is echoed back in written.
+        """
+        if self.error is not None:
+            raise self.error
+        self.queue.put((output_path, filename, list(timestamps), source))
+
+    def writer(self) -> None:
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            if self.error is not None:
+                continue
+            output_path, filename, timestamps, source = item
+            try:
+                data = self.encode(filename, timestamps)
+                with open(output_path, 'wb') as f:
+                    f.write(data)
+                self.written.append((source, output_path))
+                logger.info(f"JSON exported: {output_path}")
+            except BaseException as e:
+                self.error = e
+
+    def close(self) -> None:
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+        if self.error is not None:
+            raise self.error
@@ -0,0 +1,119 @@
+import os
+import json
+import wave
+import base64
+import hashlib
+import contextlib
+import numpy as np
+from pydantic import BaseModel
+from pathlib import Path
+from typing import Dict, Any, Optional
+from loguru import logger
+
+# bump when the VAD output for the same inputs would change
+CACHE_VERSION = 1
+
+class VADCache(BaseModel):
+    """
+    On-disk cache of VoiceDetect.do_timestamps results.
+    Keyed by audio content hash + aggressiveness, frame duration and sample rate,
+    so changing any of them is a miss. Least recently used entries are evicted
+    once the cache grows past max_bytes.
+    """
+    cache_dir: Path
+    max_bytes: int = 2**30
+    hits: int = 0
+    misses: int = 0
+
+    @staticmethod
+    def file_hash(path: Path, block_size: int = 2**20) -> str:
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(block_size), b''):
+                digest.update(block)
+        return digest.hexdigest()
+
+    def key(self, 
+            path: Path, 
+            aggressiveness: int, 
+            frame_duration_ms: int, 
+            variant: str = '', 
+            sample_rate: int = None) -> str:
+        """
+        variant tells apart detection methods whose output can differ for the same settings (e.g. sharded).
+        sample_rate is read from the .wav header unless given (e.g. the rate ffmpeg decodes to).
+        """
+        if sample_rate is None:
+            with contextlib.closing(wave.open(str(path), 'rb')) as wf:
+                sample_rate = wf.getframerate()
+        params = f"{self.file_hash(path)}:{aggressiveness}:{frame_duration_ms}:{sample_rate}:{variant}:{CACHE_VERSION}"
+        return hashlib.sha256(params.encode()).hexdigest()
+
+    def entry_path(self, key: str) -> Path:
+        return Path(self.cache_dir) / (key + '.json')
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        """
+        Returns the cached VoiceDetect fields for a key, or None on a miss.
+        """
+        entry_path = self.entry_path(key)
+        try:
+            with open(entry_path) as f:
+                entry = json.load(f)
+            os.utime(entry_path) # mark as recently used
+        except (OSError, ValueError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        if entry['speech_mask'] is not None:
+            packed = np.frombuffer(base64.b64decode(entry['speech_mask']), dtype=np.uint8)
+            entry['speech_mask'] = np.unpackbits(packed, count=entry.pop('num_frames'))
+        return entry
+
+    def put(self, key: str, timestamps: Any, speech_mask: Any, frame_duration_ms: int) -> None:
+        entry = {
+                'timestamps': [ts._asdict() for ts in timestamps],
+                'speech_mask': None,
+                'frame_duration_ms': frame_duration_ms
+                }
+        if speech_mask is not None:
+            entry['speech_mask'] = base64.b64encode(np.packbits(speech_mask).tobytes()).decode()
+            entry['num_frames'] = len(speech_mask)
+        os.makedirs(self.cache_dir, exist_ok=True)
+        entry_path = self.entry_path(key)
+        tmp_path = entry_path.with_suffix(f'.{os.getpid()}.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump(entry, f)
+        os.replace(tmp_path, entry_path) # workers may write at the same time
+        self.evict()
+
+    def entries(self):
+        entries = []
+        for entry_path in Path(self.cache_dir).glob('*.json'):
+            with contextlib.suppress(FileNotFoundError):
+                stat = entry_path.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry_path))
+        return entries
+
+    def evict(self) -> None:
+        """
+        Deletes least recently used entries until the cache fits in max_bytes.
+        """
+        entries = sorted(self.entries())
+        total = sum(size for _, size, _ in entries)
+        for _, size, entry_path in entries:
+            if total <= self.max_bytes:
+                break
+            with contextlib.suppress(FileNotFoundError):
+                entry_path.unlink()
+                logger.info(f"Evicted VAD cache entry: {entry_path.name}")
+            total -= size
+
+    def stats(self) -> Dict[str, int]:
+        entries = self.entries()
+        return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'entries': len(entries),
+                'bytes': sum(size for _, size, _ in entries)
+                }
@@ -0,0 +1,327 @@
+from pydantic import BaseModel
+from pathlib import Path
+from typing import Dict, List, Any, Tuple
+from loguru import logger
+from time import perf_counter
+import json
+import argparse
+import contextlib
+
+import asyncio
+
+import numpy as np
+# imported up front (unlike the batch modules): a long-running service shouldn't pay for it on its first stream
+import webrtcvad
+
+from voice_audio_timestamps import VoiceDetect, DEFAULT_AGGRESSIVENESS
+from clean_timestamps import Timestamps
+from pcm_convert import VADConverter
+from instrumentation import measure
+from vad_sweep import VAD_FRAME_DURATIONS
+
+DEFAULT_PORT = 8765
+READ_SIZE = 65536
+# pending connections the socket queues; load tests open hundreds at once
+BACKLOG = 1024
+
+class StreamConfig(BaseModel):
+    """
+    The JSON header line a client opens its stream with; raw PCM in this format follows until EOF.
+    """
+    stream_id: str = None
+    sample_rate: int = 16000
+    sample_width: int = 2
+    num_channels: int = 1
+    # None averages the channels, an int uses only that one
+    channel: int = None
+    frame_duration_ms: int = 30
+    aggressiveness: int = DEFAULT_AGGRESSIVENESS
+    timestamp_merge_window: float = 1
+
+class StreamState:
+    """
+    Incremental VoiceDetect for one live stream: converts whatever bytes arrive to VAD input,
+    runs VAD on every complete frame straight away and turns the decisions into events:
+    start (as soon as the first voiced frame is in), stop (on the first unvoiced frame after a run;
+    'decided' is the end of the frame an event was decided on), and segment (a cleaned, merged timestamp, sent as soon as no later run can merge into it).
+    Times follow VoiceDetect.speech_runs and segments follow CleanTimestamps.clean, so a stream
+    ends up with the same timestamps as batch detection of the same audio.
+    """
+    def __init__(self, config: StreamConfig):
+        if config.frame_duration_ms not in VAD_FRAME_DURATIONS:
+            raise ValueError(f"webrtcvad takes {VAD_FRAME_DURATIONS} ms frames, not {config.frame_duration_ms}")
+        self.config = config
+        self.converter = VADConverter(config.sample_rate, config.sample_width, config.num_channels, config.channel)
+        self.vad = webrtcvad.Vad(config.aggressiveness)
+        self.frame_bytes = int(self.converter.vad_rate * config.frame_duration_ms / 1000) * 2
+        self.source_frame_bytes = config.sample_width * config.num_channels
+        self.source_pending = b''
+        self.pending = b''
+        self.frame_index = 0
+        self.run_start: int = None
+        self.segment: Timestamps = None
+        self.events = 0
+        self.latencies_ms: List[float] = []
+        self.started = perf_counter()
+
+    def seconds(self, frames: int) -> float:
+        # same arithmetic as VoiceDetect.get_timestamps, so the floats come out identical
+        return frames * self.config.frame_duration_ms / 1000
+
+    def feed(self, data: bytes) -> List[Dict[str, Any]]:
+        """
+        Takes the next chunk of source PCM; returns the events it completes.
+        """
+        data = self.source_pending + data
+        usable = len(data) - len(data) % self.source_frame_bytes
+        self.source_pending = data[usable:]
+        audio = self.pending + self.converter.convert(data[:usable])
+        events = []
+        end = len(audio) - len(audio) % self.frame_bytes
+        for offset in range(0, end, self.frame_bytes):
+            events += self.frame(self.vad.is_speech(audio[offset:offset + self.frame_bytes], self.converter.vad_rate))
+        self.pending = audio[end:]
+        self.events += len(events)
+        return events
+
+    def frame(self, is_speech: bool) -> List[Dict[str, Any]]:
+        index = self.frame_index
+        self.frame_index += 1
+        events = []
+        if is_speech:
+            if self.run_start is None:
+                self.run_start = index
+                events.append({'event': 'start', 'time': self.seconds(index + 1), 'decided': self.seconds(index + 1)})
+            return events
+        if self.run_start is not None:
+            events += self.close_run(Timestamps(self.seconds(self.run_start + 1), self.seconds(index)), self.seconds(index + 1))
+        # the earliest a later run can start is the end of the next frame
+        if self.segment is not None and self.seconds(index + 2) - self.segment.stop >= self.config.timestamp_merge_window:
+            events.append(self.segment_event())
+        return events
+
+    def close_run(self, run: Timestamps, decided: float) -> List[Dict[str, Any]]:
+        self.run_start = None
+        events = [{'event': 'stop', 'start': run.start, 'time': run.stop, 'decided': decided}]
+        if self.segment is not None and run.start - self.segment.stop < self.config.timestamp_merge_window:
+            self.segment = Timestamps(self.segment.start, run.stop)
+        else:
+            if self.segment is not None:
+                events.append(self.segment_event())
+            self.segment = run
+        return events
+
+    def segment_event(self) -> Dict[str, Any]:
+        segment, self.segment = self.segment, None
+        return {'event': 'segment', 'start': segment.start, 'stop': segment.stop}
+
+    def finish(self) -> List[Dict[str, Any]]:
+        """
+        End of stream: closes an open run (ending with the last frame) and flushes the last segment.
+        """
+        events = []
+        if self.run_start is not None:
+            end = self.seconds(self.frame_index)
+            events += self.close_run(Timestamps(self.seconds(self.run_start + 1), end), end)
+        if self.segment is not None:
+            events.append(self.segment_event())
+        self.events += len(events)
+        return events
+
+    def metrics(self) -> Dict[str, Any]:
+        """
+        Per-stream metrics; latency is from a chunk arriving to its events being handed to the socket.
+        """
+        latencies = np.array(self.latencies_ms or [0.0])
+        data = {
+                'frames': self.frame_index,
+                'audio_seconds': self.seconds(self.frame_index),
+                'wall_seconds': perf_counter() - self.started,
+                'chunks': len(self.latencies_ms),
+                'events': self.events,
+                'latency_ms_p50': float(np.percentile(latencies, 50)),
+                'latency_ms_p95': float(np.percentile(latencies, 95)),
+                'latency_ms_max': float(latencies.max())
+                }
+        return data
+
+def encode(event: Dict[str, Any]) -> bytes:
+    return json.dumps(event, separators=(',', ':')).encode() + b'\n'
+
+async def handle_stream(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+    """
+    One client connection: a StreamConfig JSON line, then PCM until EOF. Events go back as JSON lines,
+    ending with {"event": "end", "metrics": {...}}.
+    VAD runs inline on the event loop: a 30 ms frame takes webrtcvad microseconds, and going
+    through the process pool would cost more than that in latency.
+    """
+    try:
+        config = StreamConfig(**json.loads(await reader.readline()))
+        state = StreamState(config)
+    except Exception as e:
+        writer.write(encode({'event': 'error', 'message': str(e)}))
+        await writer.drain()
+        writer.close()
+        return
+    logger.info(f"Stream opened: {config.stream_id}")
+    try:
+        while True:
+            data = await reader.read(READ_SIZE)
+            received = perf_counter()
+            if not data:
+                break
+            with measure('vad_service.chunk') as counters:
+                events = state.feed(data)
+                counters['bytes_read'] = len(data)
+            if events:
+                writer.write(b''.join(map(encode, events)))
+                await writer.drain()
+            state.latencies_ms.append((perf_counter() - received) * 1000)
+        events = state.finish()
+        events.append({'event': 'end', 'metrics': state.metrics()})
+        writer.write(b''.join(map(encode, events)))
+        await writer.drain()
+        logger.info(f"Stream closed: {config.stream_id}, {state.metrics()}")
+    except (OSError, asyncio.IncompleteReadError):
+        logger.info(f"Stream dropped: {config.stream_id}")
+    except Exception as e:
+        logger.info(f"Stream failed: {config.stream_id}, {e!r}")
+        with contextlib.suppress(OSError):
+            writer.write(encode({'event': 'error', 'message': str(e)}))
+            await writer.drain()
+    finally:
+        writer.close()
+
+async def start_service(socket_path: Path = None, host: str = '127.0.0.1', port: int = DEFAULT_PORT) -> asyncio.AbstractServer:
+    """
+    Starts the VAD service on a Unix socket (socket_path) or else on TCP host:port.
+    """
+    if socket_path:
+        server = await asyncio.start_unix_server(handle_stream, str(socket_path), backlog=BACKLOG)
+    else:
+        server = await asyncio.start_server(handle_stream, host, port, backlog=BACKLOG)
+    logger.info(f"VAD service listening on: {socket_path or f'{host}:{port}'}")
+    return server
+
+async def serve(socket_path: Path = None, host: str = '127.0.0.1', port: int = DEFAULT_PORT) -> None:
+    server = await start_service(socket_path, host, port)
+    async with server:
+        await server.serve_forever()
+
+def run_service(socket_path: Path = None, host: str = '127.0.0.1', port: int = DEFAULT_PORT):
+    return asyncio.run(serve(socket_path, host, port))
+
+async def open_stream(socket_path: Path = None, host: str = '127.0.0.1', port: int = DEFAULT_PORT) -> Tuple[asyncio.StreamReader, asyncio.StreamWriter]:
+    if socket_path:
+        return await asyncio.open_unix_connection(str(socket_path))
+    return await asyncio.open_connection(host, port)
+
+async def stream_file(path: Path,
+                      socket_path: Path = None,
+                      host: str = '127.0.0.1',
+                      port: int = DEFAULT_PORT,
+                      chunk_ms: int = 20,
+                      realtime: bool = True,
+                      seconds: float = None,
+                      **config: Any) -> Dict[str, Any]:
+    """
+    Test client: sends a .wav's PCM to the service in chunk_ms chunks (paced like live audio
+    when realtime), and collects the events. Event latency is measured end to end: from sending
+    the chunk that completed an event's frame to receiving the event.
+    """
+    source = VoiceDetect.read_source(path)
+    frame_width = source.sample_width * source.num_channels
+    pcm_data = memoryview(source.pcm_data)
+    if seconds is not None:
+        pcm_data = pcm_data[:int(seconds * source.sample_rate) * frame_width]
+    chunk_bytes = int(source.sample_rate * chunk_ms / 1000) * frame_width
+    bytes_per_second = source.sample_rate * frame_width
+    reader, writer = await open_stream(socket_path, host, port)
+    writer.write(encode({'sample_rate': source.sample_rate, 'sample_width': source.sample_width,
+                         'num_channels': source.num_channels, 'stream_id': str(path), **config}))
+    # (bytes sent so far, when) after every chunk
+    sent: List[Tuple[int, float]] = []
+
+    async def send():
+        t1_start = perf_counter()
+        for offset in range(0, len(pcm_data), chunk_bytes):
+            if realtime:
+                await asyncio.sleep(max(0.0, t1_start + offset / bytes_per_second - perf_counter()))
+            writer.write(pcm_data[offset:offset + chunk_bytes])
+            await writer.drain()
+            sent.append((min(offset + chunk_bytes, len(pcm_data)), perf_counter()))
+        writer.write_eof()
+
+    sender = asyncio.create_task(send())
+    events, latencies_ms = [], []
+    async for line in reader:
+        received = perf_counter()
+        event = json.loads(line)
+        events.append(event)
+        if event['event'] in ('start', 'stop') and sent:
+            # the chunk that carried the end of the frame the event was decided on
+            needed = event['decided'] * bytes_per_second
+            sent_at = next((when for sent_bytes, when in sent if sent_bytes >= needed), sent[-1][1])
+            latencies_ms.append((received - sent_at) * 1000)
+    await sender
+    writer.close()
+    data = {
+            'events': events,
+            'segments': [Timestamps(event['start'], event['stop']) for event in events if event['event'] == 'segment'],
+            'latencies_ms': latencies_ms,
+            'server_metrics': events[-1].get('metrics') if events else None
+            }
+    return data
+
+async def build_load_test(path: Path,
+                          stream_counts = (1, 10, 50, 100),
+                          socket_path: Path = None,
+                          host: str = '127.0.0.1',
+                          port: int = DEFAULT_PORT,
+                          seconds: float = 30,
+                          chunk_ms: int = 20,
+                          latency_budget_ms: float = 30) -> Dict[str, Dict[str, float]]:
+    """
+    Streams the same file from N concurrent real-time clients for each N, against a running service.
+    A stream count is sustained when p95 event latency stays under latency_budget_ms (one frame by default).
+    lag_seconds is how much longer than the audio the whole round took, connecting included.
+    All clients share this process's event loop, so run it apart from the service; at high counts
+    the client side saturates too, which makes the result a lower bound.
+    """
+    results = {}
+    for stream_count in stream_counts:
+        t1_start = perf_counter()
+        streams = await asyncio.gather(*(stream_file(path, socket_path, host, port, chunk_ms, True, seconds,
+                                                     stream_id=f'load-{stream_count}-{index}')
+                                         for index in range(stream_count)))
+        wall_seconds = perf_counter() - t1_start
+        latencies = np.array([latency for stream in streams for latency in stream['latencies_ms']] or [0.0])
+        audio_seconds = max(stream['server_metrics']['audio_seconds'] for stream in streams)
+        results[str(stream_count)] = {
+                                      'latency_ms_p50': float(np.percentile(latencies, 50)),
+                                      'latency_ms_p95': float(np.percentile(latencies, 95)),
+                                      'latency_ms_max': float(latencies.max()),
+                                      'lag_seconds': wall_seconds - audio_seconds,
+                                      'sustained': bool(np.percentile(latencies, 95) < latency_budget_ms)
+                                      }
+        logger.info(f"{stream_count} streams: {results[str(stream_count)]}")
+    return results
+
+def run_load_test(path: Path, stream_counts = (1, 10, 50, 100), socket_path: Path = None,
+                  host: str = '127.0.0.1', port: int = DEFAULT_PORT, seconds: float = 30):
+    return asyncio.run(build_load_test(path, stream_counts, socket_path, host, port, seconds))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Real-time VAD service over a local socket')
+    parser.add_argument('command', choices=['serve', 'load-test'])
+    parser.add_argument('--socket', help='Unix socket path (default: TCP on --host/--port)')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--wav', help='audio the load-test clients stream')
+    parser.add_argument('--streams', type=int, nargs='+', default=[1, 10, 50, 100])
+    parser.add_argument('--seconds', type=float, default=30)
+    args = parser.parse_args()
+    if args.command == 'serve':
+        run_service(args.socket, args.host, args.port)
+    else:
+        run_load_test(args.wav, args.streams, args.socket, args.host, args.port, args.seconds)
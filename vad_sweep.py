@@ -0,0 +1,151 @@
+from pydantic import BaseModel
+from pathlib import Path
+from typing import List, Union, Iterable
+from loguru import logger
+from time import perf_counter
+import os
+import csv
+import itertools
+
+import asyncio
+from functools import partial
+from glob import glob
+
+import numpy as np
+
+from scheduler import map_bounded
+from voice_audio_timestamps import VoiceDetect
+from clean_timestamps import CleanTimestamps
+
+# frame sizes webrtcvad takes
+VAD_FRAME_DURATIONS = (10, 20, 30)
+
+class SweepRow(BaseModel):
+    path: Path
+    aggressiveness: int
+    frame_duration_ms: int
+    timestamp_merge_window: float
+    # share of frames VAD marked as speech
+    speech_ratio: float
+    # share of the file covered by the merged timestamps
+    clean_speech_ratio: float
+    raw_segments: int
+    segments: int
+    # the file's one read + conversion to VAD input, shared by every row of the file
+    decode_seconds: float
+    # this row's VAD pass (shared by every merge window of the same setting)
+    vad_seconds: float
+    clean_seconds: float
+
+class VADSweep(BaseModel):
+
+    @staticmethod
+    def sweep_file(path: Path,
+                   aggressiveness_levels: Iterable[int] = (0, 1, 2, 3),
+                   frame_durations: Iterable[int] = VAD_FRAME_DURATIONS,
+                   merge_windows: Iterable[float] = (0.5, 1, 2),
+                   channel: Union[int, str] = None,
+                   energy_threshold: float = None) -> List[SweepRow]:
+        """
+        Reads and converts one .wav once, then runs every aggressiveness x frame size combination
+        over that same buffer (a fresh Vad per pass) and merges each pass with every merge window.
+        channel works as in VoiceDetect.detect_source.
+        """
+        t1_start = perf_counter()
+        source = VoiceDetect.read_source(path)
+        channels = range(source.num_channels) if channel == 'any' else [channel]
+        vad_inputs = [VoiceDetect.vad_input(source, index) for index in channels]
+        duration = len(source.pcm_data) / (source.sample_rate * source.sample_width * source.num_channels)
+        decode_seconds = perf_counter() - t1_start
+        rows = []
+        for aggressiveness, frame_duration_ms in itertools.product(aggressiveness_levels, frame_durations):
+            vad_start = perf_counter()
+            speech_mask = np.maximum.reduce([VoiceDetect.detect_pcm(vad_input, aggressiveness, frame_duration_ms,
+                                                                    energy_threshold)
+                                             for vad_input in vad_inputs])
+            raw_timestamps = VoiceDetect.get_timestamps(speech_mask, frame_duration_ms)
+            vad_seconds = perf_counter() - vad_start
+            detected = VoiceDetect(path=path, timestamps=raw_timestamps, frame_duration_ms=frame_duration_ms)
+            for timestamp_merge_window in merge_windows:
+                clean_start = perf_counter()
+                cleaned = CleanTimestamps.clean(detected, timestamp_merge_window)
+                clean_seconds = perf_counter() - clean_start
+                covered = sum(ts.stop - ts.start for ts in cleaned.clean_timestamps)
+                data = {
+                        'path': path,
+                        'aggressiveness': aggressiveness,
+                        'frame_duration_ms': frame_duration_ms,
+                        'timestamp_merge_window': timestamp_merge_window,
+                        'speech_ratio': float(speech_mask.mean()) if len(speech_mask) else 0.0,
+                        'clean_speech_ratio': covered / duration if duration else 0.0,
+                        'raw_segments': len(raw_timestamps),
+                        'segments': len(cleaned.clean_timestamps),
+                        'decode_seconds': decode_seconds,
+                        'vad_seconds': vad_seconds,
+                        'clean_seconds': clean_seconds
+                        }
+                rows.append(SweepRow(**data))
+        return rows
+
+    @staticmethod
+    def format_table(rows: List[SweepRow]) -> str:
+        """
+        The comparison table: one line per file and setting, aligned for reading in a terminal.
+        """
+        header = ['file', 'aggr', 'frame_ms', 'merge_s', 'speech', 'clean_speech', 'raw_segs', 'segs', 'vad_s']
+        lines = [[Path(row.path).name, str(row.aggressiveness), str(row.frame_duration_ms),
+                  f'{row.timestamp_merge_window:g}', f'{row.speech_ratio:.3f}', f'{row.clean_speech_ratio:.3f}',
+                  str(row.raw_segments), str(row.segments), f'{row.vad_seconds:.3f}'] for row in rows]
+        widths = [max(len(line[column]) for line in [header] + lines) for column in range(len(header))]
+        return '\n'.join('  '.join(cell.rjust(width) for cell, width in zip(line, widths)) for line in [header] + lines)
+
+    @staticmethod
+    def write_csv(rows: List[SweepRow], output_path: Path) -> Path:
+        records = [row.dict() for row in rows]
+        with open(output_path, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=list(records[0]) if records else [])
+            writer.writeheader()
+            writer.writerows(records)
+        logger.info(f"Sweep table written: {output_path}")
+        return output_path
+
+async def build_sweep(wav_directory,
+                      aggressiveness_levels: Iterable[int] = (0, 1, 2, 3),
+                      frame_durations: Iterable[int] = VAD_FRAME_DURATIONS,
+                      merge_windows: Iterable[float] = (0.5, 1, 2),
+                      channel: Union[int, str] = None,
+                      energy_threshold: float = None,
+                      max_workers: int = None) -> List[SweepRow]:
+    """
+    Parameter sweep over a glob: one pool task per file, which reads the file once and runs
+    every setting on it, so the cost grows with the number of VAD passes, not of decodes.
+    """
+    t1_start = perf_counter()
+    aggressiveness_levels, frame_durations, merge_windows = list(aggressiveness_levels), list(frame_durations), list(merge_windows)
+    for frame_duration_ms in frame_durations:
+        if frame_duration_ms not in VAD_FRAME_DURATIONS:
+            raise ValueError(f"webrtcvad takes {VAD_FRAME_DURATIONS} ms frames, not {frame_duration_ms}")
+    calls = (partial(VADSweep.sweep_file, wav, aggressiveness_levels, frame_durations, merge_windows,
+                     channel, energy_threshold) for wav in map(os.path.abspath, glob(wav_directory)))
+    rows = []
+    async for result in map_bounded(calls, max_workers=max_workers):
+        logger.info(f"Sweep completed for file: {result[0].path if result else None}")
+        rows += result
+    rows.sort(key=lambda row: (str(row.path), row.aggressiveness, row.frame_duration_ms, row.timestamp_merge_window))
+    t1_stop = perf_counter()
+    logger.info(f"Task complete! Elapsed time: {t1_stop - t1_start}")
+    return rows
+
+def run_sweep(wav_directory = None,
+              aggressiveness_levels: Iterable[int] = (0, 1, 2, 3),
+              frame_durations: Iterable[int] = VAD_FRAME_DURATIONS,
+              merge_windows: Iterable[float] = (0.5, 1, 2),
+              output_path: Path = 'vad_sweep.csv') -> List[SweepRow]:
+    rows = asyncio.run(build_sweep(wav_directory, aggressiveness_levels, frame_durations, merge_windows))
+    logger.info(f"VAD sweep:\n{VADSweep.format_table(rows)}")
+    if output_path:
+        VADSweep.write_csv(rows, output_path)
+    return rows
+
+if __name__ == '__main__':
+    run_sweep()
@@ -1,71 +1,164 @@
+import os
 import contextlib
-from distutils.command.build import build
+import mmap
 import wave
-import webrtcvad
+import numpy as np
 from pydantic import BaseModel
-from typing import Dict, List, Any, Union
+from typing import Dict, List, Any, Union, Callable, Iterable, Iterator, Tuple, AsyncIterator, NamedTuple
 from pathlib import Path
 from loguru import logger
-import subprocess
 from time import perf_counter
-import regex as re
 
 import asyncio
 from functools import partial
-from asyncio.events import AbstractEventLoop
-from concurrent.futures import ProcessPoolExecutor
 from glob import glob
 
+from worker_pool import get_process_pool
+from scheduler import map_bounded
+from vad_cache import VADCache
+from convert_audio import AudioConversion
+from pcm_convert import VADConverter
+from instrumentation import instrumented, measure, run_in_pool
+from clean_timestamps import Timestamps
+
 
 # set aggressiveness; 0 = beast mode aggressive, 3 = gentle
-vad = webrtcvad.Vad(3)
+# a fresh webrtcvad.Vad is made per file, so results don't depend on what a worker ran before
+DEFAULT_AGGRESSIVENESS = 3
+# rate ffmpeg decodes to when it feeds VAD directly
+FFMPEG_SAMPLE_RATE = 16000
+# frames processed per numpy block when computing frame energy
+ENERGY_BLOCK_FRAMES = 4096
+# gated-out frames run through the Vad (decisions dropped) ahead of each loud stretch,
+# so its noise model sees some of the silence it would have seen ungated
+GATE_PRIMING_FRAMES = 3
 
 class WaveInfo(BaseModel):
     pcm_data: Any
     sample_rate: int
+    sample_width: int = 2
+    num_channels: int = 1
 
-class Frame(BaseModel):
+# made in bulk (one per frame), so plain tuples rather than models
+class Frame(NamedTuple):
     audio: bytes
-    timestamp: str
+    timestamp: float
     duration: float
 
-class VoicedFrames(BaseModel):
+class VoicedFrames(NamedTuple):
     frame: Any
     is_speech: bool
     time: float
 
-class Timestamps(BaseModel):
-    start: float
-    stop: float
-
 class VoiceDetect(BaseModel):
     path: Path = None
     # wave_info: WaveInfo = None
     # voiced_frames: List[VoicedFrames] = None
     timestamps: List[Timestamps] = None
+    # per-frame speech decisions (uint8 array), kept for re-segmentation; not kept in stream mode
+    speech_mask: Any = None
+    frame_duration_ms: int = 30
+    cache_hit: bool = None
 
     @staticmethod
-    def read_wave(path: Path) -> WaveInfo:
+    def check_wave(wf: wave.Wave_read, channel: int = None) -> VADConverter:
       """
-      Reads a .wav file.
-      Takes the path, and returns (PCM audio data, sample rate).
+      Checks an open .wav file (any channel count and rate, 8 to 32-bit) and returns the
+      VADConverter that turns its PCM into what webrtcvad takes (mono, 16-bit, 8/16/32/48 kHz).
+      Files that already are that pass through untouched.
+      """
+      return VADConverter(wf.getframerate(), wf.getsampwidth(), wf.getnchannels(), channel)
+
+    @staticmethod
+    @instrumented('read_wave', lambda result, *args, **kwargs: {'bytes_read': len(result.pcm_data) if result else 0})
+    def read_source(path: Path) -> WaveInfo:
+      """
+      Reads a .wav file as it is, whatever its format.
+      Takes the path, and returns (PCM audio data, sample rate, sample width, channels).
       """
       path_ = Path(path)
       if path_.suffix == '.wav':
-          with contextlib.closing(wave.open(path, 'rb')) as wf:
-              num_channels = wf.getnchannels()
-              assert num_channels == 1
-              sample_width = wf.getsampwidth()
-              assert sample_width == 2
-              sample_rate = wf.getframerate()
-              assert sample_rate in (8000, 16000, 32000, 48000)
-              pcm_data = wf.readframes(wf.getnframes())
-              data = {'pcm_data': pcm_data, 'sample_rate': sample_rate}
+          with contextlib.closing(wave.open(str(path), 'rb')) as wf:
+              data = {
+                      'pcm_data': wf.readframes(wf.getnframes()), 
+                      'sample_rate': wf.getframerate(),
+                      'sample_width': wf.getsampwidth(),
+                      'num_channels': wf.getnchannels()
+                      }
               return WaveInfo(**data)
       else:
           logger.info('Wrong filetype! Requires .wav')
 
     @staticmethod
+    def vad_input(source: WaveInfo, channel: int = None) -> WaveInfo:
+      """
+      Downmixes (or picks channel) and resamples decoded PCM to VAD input, in one vectorized pass.
+      """
+      converter = VADConverter(source.sample_rate, source.sample_width, source.num_channels, channel)
+      if converter.passthrough:
+          return source
+      with measure('vad_convert') as counters:
+          pcm_data = converter.convert(source.pcm_data)
+          counters['bytes_read'] = len(source.pcm_data)
+      return WaveInfo(pcm_data=pcm_data, sample_rate=converter.vad_rate)
+
+    @staticmethod
+    def read_wave(path: Path, channel: int = None) -> WaveInfo:
+      """
+      Reads a .wav file as VAD input (see vad_input).
+      Takes the path, and returns (PCM audio data, sample rate).
+      """
+      source = VoiceDetect.read_source(path)
+      if source is not None:
+          return VoiceDetect.vad_input(source, channel)
+
+    @staticmethod
+    def find_data_chunk(buf: Any) -> Tuple[int, int]:
+      """
+      Walks the RIFF chunks of a .wav buffer.
+      Returns (offset, length) of the PCM data chunk.
+      """
+      offset = 12
+      while offset + 8 <= len(buf):
+          chunk_id = bytes(buf[offset:offset + 4])
+          chunk_size = int.from_bytes(buf[offset + 4:offset + 8], 'little')
+          if chunk_id == b'data':
+              return offset + 8, min(chunk_size, len(buf) - offset - 8)
+          offset += 8 + chunk_size + (chunk_size & 1)
+      raise ValueError('No data chunk found in .wav file')
+
+    @staticmethod
+    @contextlib.contextmanager
+    def map_wave(path: Path) -> Iterator[WaveInfo]:
+      """
+      Memory-maps a .wav file read-only.
+      Yields a WaveInfo (source format, see read_source) whose pcm_data is a memoryview 
+      over the mapped PCM data; nothing is copied.
+      """
+      with contextlib.closing(wave.open(str(path), 'rb')) as wf:
+          data = {'sample_rate': wf.getframerate(), 'sample_width': wf.getsampwidth(), 'num_channels': wf.getnchannels()}
+          num_bytes = wf.getnframes() * wf.getsampwidth() * wf.getnchannels()
+      with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+          offset, length = VoiceDetect.find_data_chunk(mm)
+          pcm_data = memoryview(mm)[offset:offset + min(length, num_bytes)]
+          try:
+              yield WaveInfo(pcm_data=pcm_data, **data)
+          finally:
+              pcm_data.release()
+
+    @staticmethod
+    def frame_views(audio: Any, sample_rate: int, frame_duration_ms: int = 30) -> Iterator[memoryview]:
+        """
+        Zero-copy version of frame_generator.
+        Yields a memoryview per frame over the PCM buffer; a frame's time comes from its index.
+        """
+        n = int(sample_rate * (frame_duration_ms / 1000.0) * 2)
+        audio = memoryview(audio)
+        for offset in range(0, len(audio) - n + 1, n):
+            yield audio[offset:offset + n]
+
+    @staticmethod
+    @instrumented('frame_generator', lambda result, *args, **kwargs: {'frames': len(result)})
     def frame_generator(audio, sample_rate, frame_duration_ms: int = 30):
         """
         Generates audio frames from PCM audio data.
@@ -78,64 +171,352 @@ class VoiceDetect(BaseModel):
         timestamp = 0.0
         duration = (float(n) / sample_rate) / 2.0
         frames = []
-        while offset + n < len(audio):
-            data = {
-                    'audio': audio[offset:offset + n],
-                    'timestamp': timestamp,
-                    'duration': duration
-                    }
-            frames.append(data)
+        while offset + n <= len(audio):
+            frames.append(Frame(audio[offset:offset + n], timestamp, duration))
             timestamp += duration
             offset += n
         return frames
 
     @staticmethod
-    def get_voiced_frames(frames, sample_rate: int, frame_duration_ms: int = 30) -> List[VoicedFrames]:
-        frame_duration_seconds = 0
-        voiced_frames_data = []
-        for frame in frames:
-            is_speech = vad.is_speech(frame['audio'], sample_rate)
-            frame_duration_seconds += frame_duration_ms / 1000
+    @instrumented('get_voiced_frames', lambda result, *args, **kwargs: {'frames': len(result)})
+    def get_voiced_frames(frames: Iterable[Any], 
+                          sample_rate: int, 
+                          *,
+                          aggressiveness: int = DEFAULT_AGGRESSIVENESS) -> np.ndarray:
+        """
+        Runs VAD over frames: Frames from frame_generator, or bare frame audio (bytes or memoryviews).
+        Returns the speech mask: one uint8 per frame, 1 = speech.
+        """
+        # imported here, not at the top: it drags in pkg_resources, which the driver process never needs
+        import webrtcvad
+        vad = webrtcvad.Vad(aggressiveness)
+        return np.fromiter((vad.is_speech(frame.audio if isinstance(frame, Frame) else frame, sample_rate) 
+                            for frame in frames), dtype=np.uint8)
+
+    @staticmethod
+    def frame_rms(audio: Any, sample_rate: int, frame_duration_ms: int = 30) -> np.ndarray:
+        """
+        RMS level (in 16-bit sample units) of every complete frame, vectorized in blocks of
+        ENERGY_BLOCK_FRAMES frames so the float copy stays small. Same frames as frame_views.
+        """
+        n = int(sample_rate * (frame_duration_ms / 1000.0) * 2)
+        samples_per_frame = n // 2
+        num_frames = len(audio) // n
+        samples = np.frombuffer(memoryview(audio)[:num_frames * n], dtype=np.int16).reshape(num_frames, samples_per_frame)
+        rms = np.empty(num_frames, dtype=np.float32)
+        for first in range(0, num_frames, ENERGY_BLOCK_FRAMES):
+            block = samples[first:first + ENERGY_BLOCK_FRAMES].astype(np.float32)
+            rms[first:first + len(block)] = np.sqrt(np.einsum('ij,ij->i', block, block) / samples_per_frame)
+        return rms
+
+    @staticmethod
+    def get_gated_voiced_frames(audio: Any,
+                                sample_rate: int,
+                                aggressiveness: int = DEFAULT_AGGRESSIVENESS,
+                                frame_duration_ms: int = 30,
+                                energy_threshold: float = 100) -> np.ndarray:
+        """
+        get_voiced_frames with an energy gate in front: frames whose RMS is under energy_threshold
+        are marked non-speech without calling webrtcvad; only the rest go through the Vad.
+        The Vad adapts its noise model to what it is fed, so the GATE_PRIMING_FRAMES gated-out frames
+        before each loud stretch are fed to it as well and their decisions dropped; without them it
+        never sees silence and cuts loud speech into pieces.
+        The skipped share shows up as frames_skipped / skipped_fraction of the energy_gate stage in the run report.
+        Differences from an ungated pass: frames under the threshold are always non-speech, so
+        webrtcvad's hangover frames that trail a speech run into silence are dropped and runs end
+        where the energy falls off.
+        """
+        n = int(sample_rate * (frame_duration_ms / 1000.0) * 2)
+        with measure('energy_gate') as counters:
+            rms = VoiceDetect.frame_rms(audio, sample_rate, frame_duration_ms)
+            loud = rms >= energy_threshold
+            fed = loud.copy()
+            for shift in range(1, GATE_PRIMING_FRAMES + 1):
+                fed[:-shift] |= loud[shift:]
+            fed = np.flatnonzero(fed)
+            counters['frames'] = len(rms)
+            counters['frames_skipped'] = len(rms) - len(fed)
+        audio = memoryview(audio)
+        speech_mask = np.zeros(len(rms), dtype=np.uint8)
+        speech_mask[fed] = VoiceDetect.get_voiced_frames((audio[i * n:i * n + n] for i in fed.tolist()), 
+                                                         sample_rate, aggressiveness=aggressiveness)
+        speech_mask[~loud] = 0
+        logger.info(f"Energy gate skipped {len(rms) - len(fed)} of {len(rms)} frames")
+        return speech_mask
+
+    @staticmethod
+    @instrumented('get_timestamps', lambda result, speech_mask, *args, **kwargs: {'frames': len(speech_mask)})
+    def get_timestamps(speech_mask: np.ndarray, frame_duration_ms: int = 30) -> List[Timestamps]:
+        """
+        Finds the speech runs in a speech mask with diff/nonzero.
+        Times are the end of the first and last voiced frame, worked out from the frame index.
+        """
+        edges = np.zeros(len(speech_mask) + 2, dtype=np.int8)
+        edges[1:-1] = speech_mask
+        edges = np.diff(edges)
+        starts = (np.flatnonzero(edges == 1) + 1) * frame_duration_ms / 1000
+        stops = np.flatnonzero(edges == -1) * frame_duration_ms / 1000
+        return [Timestamps(start, stop) for start, stop in zip(starts.tolist(), stops.tolist())]
+
+    @staticmethod
+    def stream_frames(read: Callable[[int], bytes], 
+                      sample_rate: int, 
+                      frame_duration_ms: int = 30, 
+                      block_frames: int = 1000) -> Iterator[bytes]:
+        """
+        Generates audio frames from a PCM source without loading all of it.
+        Takes a read(num_bytes) callable, and reads block_frames frames at a time from it;
+        only the current block (plus a partial frame carried over) is held in memory.
+        Yields the audio of each frame as it arrives.
+        """
+        n = int(sample_rate * (frame_duration_ms / 1000.0) * 2)
+        block_size = n * block_frames
+        pending = b''
+        while True:
+            block = read(block_size)
+            if not block:
+                break
+            if pending:
+                block = pending + block
+            end = len(block) - len(block) % n
+            for offset in range(0, end, n):
+                yield block[offset:offset + n]
+            pending = block[end:]
+
+    @staticmethod
+    def speech_runs(flags: Iterable[bool], frame_duration_ms: int = 30) -> Iterator[Timestamps]:
+        """
+        Turns per-frame speech decisions into Timestamps, yielding each one as soon as its run ends.
+        Times are the end of the first and last voiced frame, worked out from the frame index.
+        """
+        start = None
+        index = -1
+        for index, is_speech in enumerate(flags):
+            if is_speech:
+                if start is None:
+                    start = index
+            elif start is not None:
+                yield Timestamps(start=(start + 1) * frame_duration_ms / 1000, 
+                                 stop=index * frame_duration_ms / 1000)
+                start = None
+        if start is not None:
+            yield Timestamps(start=(start + 1) * frame_duration_ms / 1000, 
+                             stop=(index + 1) * frame_duration_ms / 1000)
+
+    @staticmethod
+    def stream_pcm_timestamps(read: Callable[[int], bytes],
+                              sample_rate: int,
+                              frame_duration_ms: int = 30, 
+                              block_frames: int = 1000,
+                              aggressiveness: int = DEFAULT_AGGRESSIVENESS) -> Iterator[Timestamps]:
+        """
+        Streaming voice detection over any 16-bit mono PCM source, given as a read(num_bytes) callable
+        (a file, a pipe from ffmpeg, a socket...). Yields Timestamps incrementally.
+        """
+        frames = VoiceDetect.stream_frames(read, sample_rate, frame_duration_ms, block_frames)
+        import webrtcvad
+        vad = webrtcvad.Vad(aggressiveness)
+        flags = (vad.is_speech(frame, sample_rate) for frame in frames)
+        yield from VoiceDetect.speech_runs(flags, frame_duration_ms)
+
+    @staticmethod
+    def stream_timestamps(path: Path, 
+                          frame_duration_ms: int = 30, 
+                          block_frames: int = 1000,
+                          aggressiveness: int = DEFAULT_AGGRESSIVENESS,
+                          channel: int = None) -> Iterator[Timestamps]:
+        """
+        Streaming voice detection: reads the .wav in blocks, runs VAD on each frame as it
+        arrives and yields Timestamps incrementally. Peak memory does not grow with file length.
+        Other formats are downmixed/resampled block by block on the way in.
+        """
+        with contextlib.closing(wave.open(str(path), 'rb')) as wf:
+            converter = VoiceDetect.check_wave(wf, channel)
+
+            def read(size: int) -> bytes:
+                # size is in VAD bytes; read about as many source frames
+                num_frames = max(1, size // 2 * converter.sample_rate // converter.vad_rate)
+                for block in iter(lambda: wf.readframes(num_frames), b''):
+                    block = converter.convert(block)
+                    if block:
+                        return block
+                return b''
+
+            yield from VoiceDetect.stream_pcm_timestamps(read, converter.vad_rate, 
+                                                         frame_duration_ms, block_frames, aggressiveness)
+
+    @staticmethod
+    def shard_ranges(path: Path, 
+                     shard_seconds: int = 600, 
+                     frame_duration_ms: int = 30,
+                     channel: int = None) -> List[Tuple[int, int]]:
+        """
+        Cuts a .wav into (first_frame, last_frame) ranges of about shard_seconds each.
+        """
+        with contextlib.closing(wave.open(str(path), 'rb')) as wf:
+            converter = VoiceDetect.check_wave(wf, channel)
+            num_frames = converter.vad_length(wf.getnframes()) // int(converter.vad_rate * (frame_duration_ms / 1000.0) * 2)
+        shard_frames = max(1, shard_seconds * 1000 // frame_duration_ms)
+        return [(first_frame, min(first_frame + shard_frames, num_frames)) 
+                for first_frame in range(0, num_frames, shard_frames)]
+
+    @staticmethod
+    def get_shard_mask(path: Path, 
+                       first_frame: int, 
+                       last_frame: int, 
+                       warmup_frames: int,
+                       aggressiveness: int = DEFAULT_AGGRESSIVENESS,
+                       frame_duration_ms: int = 30,
+                       channel: int = None) -> np.ndarray:
+        """
+        Speech mask for frames first_frame..last_frame of a .wav. A fresh Vad is first run over
+        the warmup_frames before the shard (the overlap) so its noise model has settled; those
+        decisions are dropped. A shard depends only on its own audio, so shards can run in any
+        process and in any order and still give the same mask.
+        Only the source audio of the shard and its warmup is converted to VAD input.
+        """
+        with VoiceDetect.map_wave(path) as source:
+            converter = VADConverter(source.sample_rate, source.sample_width, source.num_channels, channel)
+            frame_samples = int(converter.vad_rate * (frame_duration_ms / 1000.0))
+            start = max(first_frame - warmup_frames, 0)
+            if converter.passthrough:
+                pcm_data, offset = source.pcm_data, start * frame_samples * 2
+            else:
+                with measure('vad_convert') as counters:
+                    pcm_data = converter.convert_range(source.pcm_data, start * frame_samples, last_frame * frame_samples)
+                    counters['bytes_read'] = len(pcm_data) // 2 * source.sample_width * source.num_channels
+                offset = 0
+            # no view of the mapped file may outlive the map, so the shard's slice isn't kept
+            frames = VoiceDetect.frame_views(pcm_data[offset:offset + (last_frame - start) * frame_samples * 2], 
+                                             converter.vad_rate, frame_duration_ms)
+            speech_mask = VoiceDetect.get_voiced_frames(frames, converter.vad_rate, aggressiveness=aggressiveness)
+        return speech_mask[first_frame - start:]
+
+    @staticmethod
+    def detect_batch(paths: List[Path],
+                     aggressiveness: int = DEFAULT_AGGRESSIVENESS,
+                     frame_duration_ms: int = 30) -> List['VoiceDetect']:
+        """
+        Voice detection for a batch of (short) files of any format, decoded by one ffmpeg process.
+        """
+        results = []
+        for path, pcm_data in zip(paths, AudioConversion.decode_batch(paths, FFMPEG_SAMPLE_RATE)):
+            frames = VoiceDetect.frame_views(pcm_data, FFMPEG_SAMPLE_RATE, frame_duration_ms)
+            speech_mask = VoiceDetect.get_voiced_frames(frames, FFMPEG_SAMPLE_RATE, aggressiveness=aggressiveness)
             data = {
-                    'frame': frame,
-                    'is_speech': is_speech,
-                    'time': round(frame_duration_seconds, 3)
+                    'path': path,
+                    'speech_mask': speech_mask,
+                    'frame_duration_ms': frame_duration_ms,
+                    'timestamps': VoiceDetect.get_timestamps(speech_mask, frame_duration_ms)
                     }
-            voiced_frames_data.append(data)
-        return voiced_frames_data
+            results.append(VoiceDetect(**data))
+        return results
 
     @staticmethod
-    def get_timestamps(voiced_frames: VoicedFrames) -> List[Timestamps]:
-        voice_times = []
-        timestamps = []
-        for item in voiced_frames:
-            if item['is_speech'] == True:
-                voice_times.append(item['time'])
-            else:
-                if len(voice_times) > 0:
-                    data = {
-                            'start': voice_times[0],
-                            'stop': voice_times[-1]
-                            }
-                    timestamps.append(data)
-                    voice_times.clear()
-        return timestamps
-
-    def do_timestamps(self, path: Path) -> 'VoiceDetect':
+    def detect_pcm(wave_info: WaveInfo,
+                   aggressiveness: int = DEFAULT_AGGRESSIVENESS,
+                   frame_duration_ms: int = 30,
+                   energy_threshold: float = None) -> np.ndarray:
+        """
+        Speech mask of a decoded (or mapped) VAD input buffer, through the energy gate when energy_threshold is set.
+        """
+        if energy_threshold is not None:
+            return VoiceDetect.get_gated_voiced_frames(wave_info.pcm_data, wave_info.sample_rate, aggressiveness, 
+                                                       frame_duration_ms, energy_threshold)
+        frames = VoiceDetect.frame_views(wave_info.pcm_data, wave_info.sample_rate, frame_duration_ms)
+        return VoiceDetect.get_voiced_frames(frames, wave_info.sample_rate, aggressiveness=aggressiveness)
+
+    @staticmethod
+    def detect_source(source: WaveInfo,
+                      channel: Union[int, str] = None,
+                      aggressiveness: int = DEFAULT_AGGRESSIVENESS,
+                      frame_duration_ms: int = 30,
+                      energy_threshold: float = None) -> np.ndarray:
+        """
+        Speech mask of a source buffer in any wav format. channel: None averages the channels,
+        an int uses only that one, 'any' runs VAD per channel and counts a frame as speech
+        if it is speech on any channel.
+        """
+        if channel == 'any':
+            return np.maximum.reduce([VoiceDetect.detect_pcm(VoiceDetect.vad_input(source, index), aggressiveness, 
+                                                             frame_duration_ms, energy_threshold)
+                                      for index in range(source.num_channels)])
+        return VoiceDetect.detect_pcm(VoiceDetect.vad_input(source, channel), aggressiveness, 
+                                      frame_duration_ms, energy_threshold)
+
+    def do_timestamps(self, 
+                      path: Path, 
+                      mode: str = 'memory', 
+                      aggressiveness: int = DEFAULT_AGGRESSIVENESS,
+                      frame_duration_ms: int = 30,
+                      cache: VADCache = None,
+                      shard_seconds: int = 600,
+                      overlap_seconds: int = 10,
+                      energy_threshold: float = None,
+                      channel: Union[int, str] = None) -> 'VoiceDetect':
+        """
+        Runs voice detection on a .wav file. Mode can be:
+        memory (decode the whole file, then detect), stream (detect block by block),
+        mmap (detect over zero-copy views of the memory-mapped file)
+        sharded (detect shard by shard; gives exactly what build_sharded_detection gives in parallel)
+        or ffmpeg (any format ffmpeg reads: decoded PCM is piped straight into VAD, no intermediate .wav)
+        With a VADCache, results for unchanged audio + VAD settings are read from disk instead.
+        energy_threshold (memory and mmap modes) turns on the energy gate, see get_gated_voiced_frames.
+        Any .wav format works: multichannel audio is downmixed, other rates/widths resampled in-process.
+        channel picks one channel instead, or 'any' for per-channel VAD (memory and mmap modes; see detect_source).
+        """
         logger.info("Starting voice detection!")
         path_ = Path(path)
-        if path_.suffix == '.wav':
+        if path_.suffix == '.wav' or mode == 'ffmpeg':
             t1_start = perf_counter()
-            wave_info = self.read_wave(path)
-            frames = self.frame_generator(wave_info.pcm_data, wave_info.sample_rate)
-            voiced_frames = self.get_voiced_frames(frames, wave_info.sample_rate)
-            timestamps = self.get_timestamps(voiced_frames)
+            if cache is not None:
+                # memory and mmap give the same result, mask included; stream and ffmpeg keep no mask
+                variant = f'sharded:{shard_seconds}:{overlap_seconds}' if mode == 'sharded' else mode if mode in ('stream', 'ffmpeg') else ''
+                if energy_threshold is not None and mode in ('memory', 'mmap'):
+                    variant += f'gate:{energy_threshold}'
+                if channel is not None:
+                    variant += f'channel:{channel}'
+                cache_key = cache.key(path, aggressiveness, frame_duration_ms, variant, 
+                                      FFMPEG_SAMPLE_RATE if mode == 'ffmpeg' else None)
+                cached = cache.get(cache_key)
+                if cached is not None:
+                    logger.info(f"VAD cache hit: {path_.as_posix()}")
+                    return VoiceDetect(path=path, cache_hit=True, **cached)
+            speech_mask = None
+            if channel == 'any' and mode not in ('memory', 'mmap'):
+                raise ValueError(f"Per-channel VAD needs mode 'memory' or 'mmap', not '{mode}'")
+            if mode == 'stream':
+                timestamps = list(self.stream_timestamps(path, frame_duration_ms, aggressiveness=aggressiveness, 
+                                                         channel=channel))
+            elif mode == 'ffmpeg':
+                with AudioConversion.pcm_stream(path, FFMPEG_SAMPLE_RATE) as pcm:
+                    timestamps = list(self.stream_pcm_timestamps(pcm.read, FFMPEG_SAMPLE_RATE, frame_duration_ms, 
+                                                                 aggressiveness=aggressiveness))
+            elif mode == 'sharded':
+                warmup_frames = overlap_seconds * 1000 // frame_duration_ms
+                speech_mask = np.concatenate([np.empty(0, dtype=np.uint8)] + 
+                                             [self.get_shard_mask(path, first_frame, last_frame, warmup_frames, 
+                                                                  aggressiveness, frame_duration_ms, channel)
+                                              for first_frame, last_frame in self.shard_ranges(path, shard_seconds, 
+                                                                                               frame_duration_ms, channel)])
+            elif mode == 'mmap':
+                with self.map_wave(path) as source:
+                    speech_mask = self.detect_source(source, channel, aggressiveness, frame_duration_ms, energy_threshold)
+            else:
+                source = self.read_source(path)
+                speech_mask = self.detect_source(source, channel, aggressiveness, frame_duration_ms, energy_threshold)
+            if speech_mask is not None:
+                timestamps = self.get_timestamps(speech_mask, frame_duration_ms)
             data = {
                     'path': path,
                     # 'wave_info': wave_info.sample_rate,
-                    # 'voiced_frames': voiced_frames,
+                    'speech_mask': speech_mask,
+                    'frame_duration_ms': frame_duration_ms,
                     'timestamps': timestamps
                     }
+            if cache is not None:
+                cache.put(cache_key, timestamps, speech_mask, frame_duration_ms)
+                data['cache_hit'] = False
             t1_stop = perf_counter()
             logger.info(f"Done! Elapsed time: {t1_stop - t1_start}")
             return VoiceDetect(**data)
@@ -144,28 +525,118 @@ class VoiceDetect(BaseModel):
 
 
 # NOTE: Do we want these outputs to go to JSON files? Probably!
-async def build_voice_detection(wav_directory, max_workers=8) -> VoiceDetect:
+async def iter_voice_detection(wav_directory, 
+                               max_workers=None, 
+                               mode='memory', 
+                               cache: VADCache = None,
+                               max_in_flight: int = None) -> AsyncIterator[VoiceDetect]:
+    """
+    Voice detection over a glob with at most max_in_flight files submitted at once (see scheduler).
+    Yields each file's result as soon as it completes, so callers can stream results onwards.
+    """
+    # the pool's workers keep the directory they were started in
+    if cache is not None:
+        cache.cache_dir = Path(os.path.abspath(cache.cache_dir))
+    calls = (partial(VoiceDetect().do_timestamps, os.path.abspath(wav), mode, cache=cache) for wav in glob(wav_directory))
+    async for result in map_bounded(calls, max_in_flight, max_workers):
+        logger.info(f"Timestamps completed for file: {result.path}")
+        yield result
+
+async def build_voice_detection(wav_directory, 
+                                max_workers=None, 
+                                mode='memory', 
+                                cache: VADCache = None) -> VoiceDetect:
     """
     Puts voice detection into process pool and adds asynchronous return of results (timestamps).
-    max_workers is the number of cores you want to have going on this task. Default is 8.
+    max_workers is the number of cores you want to have going on this task.
+    Default is the shared pool (worker_pool), which starts with one worker per CPU.
+    mode='stream' keeps memory flat per worker on very long recordings; mode='mmap' avoids per-frame copies.
+    Pass a VADCache to skip VAD for files that were already detected with the same settings.
+    Results come back in completion order; use iter_voice_detection to handle them as they arrive.
     """
     # from Chapter 6 in Python Concurrency book
     t1_start = perf_counter()
-    with ProcessPoolExecutor(max_workers) as process_pool:
-        loop: AbstractEventLoop = asyncio.get_running_loop()
-        wav_files = glob(wav_directory)
-        calls: List[partial[int]] = [partial(VoiceDetect().do_timestamps, wav) for wav in wav_files]
-        call_coros = []
-        for call in calls: call_coros.append(loop.run_in_executor(process_pool, call))
-        results = await asyncio.gather(*call_coros)
+    results = [result async for result in iter_voice_detection(wav_directory, max_workers, mode, cache)]
+    if cache is not None:
+        # workers count on their own copies of the cache; tally here
+        cache.hits += sum(1 for result in results if result.cache_hit)
+        cache.misses += sum(1 for result in results if result.cache_hit == False)
+        logger.info(f"VAD cache stats: {cache.stats()}")
+    t1_stop = perf_counter()
+    logger.info(f"Task complete! Elapsed time: {t1_stop - t1_start}")
+    return results
+
+async def build_sharded_detection(path: Path,
+                                  shard_seconds: int = 600,
+                                  overlap_seconds: int = 10,
+                                  aggressiveness: int = DEFAULT_AGGRESSIVENESS,
+                                  frame_duration_ms: int = 30,
+                                  max_workers=None,
+                                  channel: int = None) -> VoiceDetect:
+    """
+    Voice detection for one long .wav spread over the process pool: the file is cut into
+    shard_seconds shards, each primed with overlap_seconds of the audio before it, and the
+    shard masks are stitched back together before speech runs are found, so runs crossing a
+    shard boundary come out whole. Output matches do_timestamps(mode='sharded') exactly.
+    (webrtcvad adapts its noise model over the whole file, so a handful of frames near
+    decision thresholds can differ from a single unsharded pass.)
+    channel picks one channel of a multichannel file (default: downmix).
+    """
+    t1_start = perf_counter()
+    logger.info(f"Starting sharded voice detection: {path}")
+    path = os.path.abspath(path)
+    process_pool = get_process_pool(max_workers)
+    warmup_frames = overlap_seconds * 1000 // frame_duration_ms
+    calls: List[partial[int]] = [partial(VoiceDetect.get_shard_mask, path, first_frame, last_frame, warmup_frames, 
+                                         aggressiveness, frame_duration_ms, channel)
+                                 for first_frame, last_frame in VoiceDetect.shard_ranges(path, shard_seconds, 
+                                                                                         frame_duration_ms, channel)]
+    call_coros = []
+    for call in calls: call_coros.append(run_in_pool(process_pool, call))
+    shard_masks = await asyncio.gather(*call_coros)
+    speech_mask = np.concatenate([np.empty(0, dtype=np.uint8)] + shard_masks)
+    data = {
+            'path': path,
+            'speech_mask': speech_mask,
+            'frame_duration_ms': frame_duration_ms,
+            'timestamps': VoiceDetect.get_timestamps(speech_mask, frame_duration_ms)
+            }
+    t1_stop = perf_counter()
+    logger.info(f"Task complete! {len(calls)} shards. Elapsed time: {t1_stop - t1_start}")
+    return VoiceDetect(**data)
+
+def run_sharded_detection(path: Path = None, shard_seconds: int = 600, overlap_seconds: int = 10):
+    return asyncio.run(build_sharded_detection(path, shard_seconds, overlap_seconds))
+
+async def iter_decode_detection(audio_directory,
+                                batch_size: int = 16,
+                                max_workers=None,
+                                max_in_flight: int = None) -> AsyncIterator[VoiceDetect]:
+    """
+    Voice detection straight from compressed audio (mp3, m4a, ...) with no conversion pass:
+    files are decoded batch_size at a time per ffmpeg process, so ffmpeg startup is paid once
+    per batch, and decoding of one batch overlaps VAD of others across the pool.
+    """
+    audio_files = [os.path.abspath(path) for path in glob(audio_directory)]
+    calls = (partial(VoiceDetect.detect_batch, audio_files[i:i + batch_size]) 
+             for i in range(0, len(audio_files), batch_size))
+    async for results in map_bounded(calls, max_in_flight, max_workers):
         for result in results:
             logger.info(f"Timestamps completed for file: {result.path}")
+            yield result
+
+async def build_decode_detection(audio_directory, batch_size: int = 16, max_workers=None) -> List[VoiceDetect]:
+    t1_start = perf_counter()
+    results = [result async for result in iter_decode_detection(audio_directory, batch_size, max_workers)]
     t1_stop = perf_counter()
     logger.info(f"Task complete! Elapsed time: {t1_stop - t1_start}")
     return results
 
-def run_voice_detection(wav_directory = None):
-    return asyncio.run(build_voice_detection(wav_directory))
+def run_decode_detection(audio_directory = None, batch_size: int = 16):
+    return asyncio.run(build_decode_detection(audio_directory, batch_size))
+
+def run_voice_detection(wav_directory = None, mode = 'memory', cache: VADCache = None):
+    return asyncio.run(build_voice_detection(wav_directory, mode=mode, cache=cache))
 
 if __name__ == '__main__':
     run_voice_detection()
\ No newline at end of file
@@ -0,0 +1,396 @@
+from pydantic import BaseModel
+from pathlib import Path
+from typing import Dict, Any, Callable, Iterable
+from loguru import logger
+from time import perf_counter
+import os
+import json
+import time
+import socket
+import sqlite3
+import argparse
+import threading
+import contextlib
+import multiprocessing
+from glob import glob
+
+from instrumentation import measure, drain
+
+# what each stage's result is fed to; clip stands on its own
+NEXT_STAGE = {'convert': 'detect', 'detect': 'clean', 'clean': 'split'}
+STAGES = ('convert', 'detect', 'clean', 'split', 'clip')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY,
+    path TEXT NOT NULL,
+    stage TEXT NOT NULL,
+    params TEXT NOT NULL,
+    input TEXT,
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    max_attempts INTEGER NOT NULL,
+    not_before REAL NOT NULL DEFAULT 0,
+    lease_owner TEXT,
+    lease_expires REAL,
+    result TEXT,
+    error TEXT,
+    created REAL NOT NULL,
+    updated REAL NOT NULL,
+    UNIQUE (path, stage, params)
+);
+CREATE INDEX IF NOT EXISTS jobs_ready ON jobs (status, not_before);
+CREATE TABLE IF NOT EXISTS metrics (
+    job_id INTEGER NOT NULL REFERENCES jobs (id),
+    worker TEXT NOT NULL,
+    stage TEXT NOT NULL,
+    ok INTEGER NOT NULL,
+    wall_s REAL NOT NULL,
+    cpu_s REAL NOT NULL,
+    peak_rss_kb INTEGER,
+    stages TEXT,
+    finished REAL NOT NULL
+);
+"""
+
+class Job(BaseModel):
+    id: int
+    path: str
+    stage: str
+    params: Dict[str, Any]
+    # the previous stage's result, None for the first stage
+    input: Any = None
+    attempts: int
+
+def worker_name() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+class WorkQueue:
+    """
+    Job queue in one SQLite file, shared by any number of worker processes (or hosts, with the file
+    on a shared filesystem). Jobs are (file, stage, params); a worker leases one for lease_seconds and
+    keeps it alive with heartbeats. A lease that runs out (the worker crashed or hung) makes the job
+    available again; a failed job is retried with backoff up to max_attempts. Finishing a job records
+    its result and metrics and enqueues the file's next stage in the same transaction.
+    journal_mode: 'WAL' is faster but needs every process on the same host; the default rollback
+    journal also works over network filesystems. It is set when the queue file is created and kept
+    in the file, so later connections (workers, heartbeats) just use whatever the file has.
+    """
+    def __init__(self, db_path: Path, journal_mode: str = 'DELETE', timeout: float = 60):
+        self.db_path = db_path
+        created = not os.path.exists(db_path) or os.path.getsize(db_path) == 0
+        self.connection = sqlite3.connect(str(db_path), timeout=timeout, isolation_level=None)
+        self.connection.row_factory = sqlite3.Row
+        if created:
+            self.connection.execute(f'PRAGMA journal_mode={journal_mode}')
+        self.connection.executescript(SCHEMA)
+
+    def close(self) -> None:
+        self.connection.close()
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """
+        BEGIN IMMEDIATE takes the write lock up front, so two workers can't lease the same job.
+        """
+        self.connection.execute('BEGIN IMMEDIATE')
+        try:
+            yield self.connection
+        except BaseException:
+            self.connection.execute('ROLLBACK')
+            raise
+        self.connection.execute('COMMIT')
+
+    @staticmethod
+    def insert(connection: sqlite3.Connection, path: str, stage: str, params: str, input: Any, max_attempts: int) -> int:
+        now = time.time()
+        cursor = connection.execute('INSERT OR IGNORE INTO jobs (path, stage, params, input, max_attempts, created, updated) '
+                                    'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                    (path, stage, params, json.dumps(input), max_attempts, now, now))
+        return cursor.rowcount
+
+    def enqueue(self, paths: Iterable[Path], stage: str = 'convert', params: Dict[str, Any] = None, max_attempts: int = 3) -> int:
+        """
+        Adds a job per file; files already queued for that stage and params are left as they are.
+        Returns how many were added.
+        """
+        if stage not in STAGES:
+            raise ValueError(f"Unknown stage: {stage}")
+        params = json.dumps(params or {}, sort_keys=True)
+        with self.transaction() as connection:
+            added = sum(self.insert(connection, str(Path(path).resolve()), stage, params, None, max_attempts) for path in paths)
+        logger.info(f"Queued {added} {stage} jobs")
+        return added
+
+    def lease(self, worker: str, lease_seconds: float = 60) -> Job:
+        """
+        Hands the next ready job to worker, or returns None. Ready means pending and past its backoff,
+        or leased by a worker whose lease ran out. A job out of attempts is marked failed instead.
+        """
+        with self.transaction() as connection:
+            while True:
+                now = time.time()
+                row = connection.execute("SELECT * FROM jobs WHERE (status = 'pending' AND not_before <= ?) "
+                                         "OR (status = 'leased' AND lease_expires < ?) ORDER BY id LIMIT 1",
+                                         (now, now)).fetchone()
+                if row is None:
+                    return None
+                if row['attempts'] >= row['max_attempts']:
+                    connection.execute("UPDATE jobs SET status = 'failed', lease_owner = NULL, updated = ?, "
+                                       "error = coalesce(error, 'lease expired') WHERE id = ?", (now, row['id']))
+                    continue
+                if row['status'] == 'leased':
+                    logger.info(f"Lease of {row['lease_owner']} expired, taking over job {row['id']}")
+                connection.execute("UPDATE jobs SET status = 'leased', lease_owner = ?, lease_expires = ?, "
+                                   "attempts = attempts + 1, updated = ? WHERE id = ?",
+                                   (worker, now + lease_seconds, now, row['id']))
+                data = {
+                        'id': row['id'],
+                        'path': row['path'],
+                        'stage': row['stage'],
+                        'params': json.loads(row['params']),
+                        'input': json.loads(row['input']) if row['input'] else None,
+                        'attempts': row['attempts'] + 1
+                        }
+                return Job(**data)
+
+    def heartbeat(self, job: Job, worker: str, lease_seconds: float = 60) -> bool:
+        """
+        Extends the lease; False means it was lost (expired and taken over), so the result won't count.
+        """
+        with self.transaction() as connection:
+            cursor = connection.execute("UPDATE jobs SET lease_expires = ? WHERE id = ? AND status = 'leased' AND lease_owner = ?",
+                                        (time.time() + lease_seconds, job.id, worker))
+        return cursor.rowcount == 1
+
+    def record_metrics(self, connection: sqlite3.Connection, job: Job, worker: str, ok: bool, metrics: Dict[str, Any]) -> None:
+        stage = metrics['stages'].get(f'queue.{job.stage}', {})
+        connection.execute('INSERT INTO metrics (job_id, worker, stage, ok, wall_s, cpu_s, peak_rss_kb, stages, finished) '
+                           'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                           (job.id, worker, job.stage, int(ok), stage.get('wall_s', 0.0), stage.get('cpu_s', 0.0),
+                            metrics['peak_rss_kb'], json.dumps(metrics['stages']), time.time()))
+
+    def complete(self, job: Job, worker: str, result: Any, metrics: Dict[str, Any]) -> bool:
+        """
+        Stores the result and metrics and queues the next stage, all or nothing.
+        Returns False (and stores nothing) if the worker no longer holds the lease.
+        """
+        with self.transaction() as connection:
+            cursor = connection.execute("UPDATE jobs SET status = 'done', result = ?, error = NULL, lease_owner = NULL, updated = ? "
+                                        "WHERE id = ? AND status = 'leased' AND lease_owner = ?",
+                                        (json.dumps(result), time.time(), job.id, worker))
+            if cursor.rowcount != 1:
+                return False
+            self.record_metrics(connection, job, worker, True, metrics)
+            if job.stage in NEXT_STAGE:
+                max_attempts = connection.execute('SELECT max_attempts FROM jobs WHERE id = ?', (job.id,)).fetchone()[0]
+                self.insert(connection, job.path, NEXT_STAGE[job.stage], json.dumps(job.params, sort_keys=True), result, max_attempts)
+        return True
+
+    def fail(self, job: Job, worker: str, error: str, metrics: Dict[str, Any], retry_seconds: float = 5) -> bool:
+        """
+        Puts a failed job back with backoff (retry_seconds x attempts so far), or marks it failed for good.
+        """
+        with self.transaction() as connection:
+            now = time.time()
+            cursor = connection.execute("UPDATE jobs SET status = CASE WHEN attempts < max_attempts THEN 'pending' ELSE 'failed' END, "
+                                        "not_before = ?, error = ?, lease_owner = NULL, updated = ? "
+                                        "WHERE id = ? AND status = 'leased' AND lease_owner = ?",
+                                        (now + retry_seconds * job.attempts, error, now, job.id, worker))
+            if cursor.rowcount != 1:
+                return False
+            self.record_metrics(connection, job, worker, False, metrics)
+        return True
+
+    def status(self) -> Dict[str, Dict[str, int]]:
+        """
+        Job counts: stage -> status -> count.
+        """
+        counts = {}
+        for stage, status, count in self.connection.execute('SELECT stage, status, count(*) FROM jobs GROUP BY stage, status'):
+            counts.setdefault(stage, {})[status] = count
+        return counts
+
+    def pending(self) -> int:
+        return self.connection.execute("SELECT count(*) FROM jobs WHERE status IN ('pending', 'leased')").fetchone()[0]
+
+    def results(self, stage: str) -> Dict[str, Any]:
+        return {path: json.loads(result) for path, result in
+                self.connection.execute("SELECT path, result FROM jobs WHERE stage = ? AND status = 'done'", (stage,))}
+
+    def report(self) -> Dict[str, Any]:
+        """
+        Central metrics: per stage, jobs run / failed attempts and their wall and CPU time; per worker, jobs and peak RSS.
+        """
+        stages = {}
+        for row in self.connection.execute('SELECT stage, sum(ok), sum(1 - ok), sum(wall_s), sum(cpu_s), max(wall_s) '
+                                           'FROM metrics GROUP BY stage'):
+            stages[row[0]] = {'done': row[1], 'failed_attempts': row[2], 'wall_s': row[3], 'cpu_s': row[4], 'max_wall_s': row[5]}
+        workers = {row[0]: {'jobs': row[1], 'peak_rss_kb': row[2]} for row in
+                   self.connection.execute('SELECT worker, count(*), max(peak_rss_kb) FROM metrics GROUP BY worker')}
+        data = {
+                'jobs': self.status(),
+                'stages': stages,
+                'workers': workers
+                }
+        return data
+
+def convert_job(job: Job) -> Dict[str, Any]:
+    from corpus_pipeline import convert_stage
+    directory = output_root(job, job.path)
+    os.makedirs(directory, exist_ok=True)
+    return {'path': os.path.abspath(convert_stage(job.path, job.params.get('input_type'), directory))}
+
+def detect_job(job: Job) -> Dict[str, Any]:
+    from voice_audio_timestamps import VoiceDetect
+    detected = VoiceDetect().do_timestamps(job.input['path'] if job.input else job.path, job.params.get('mode', 'memory'))
+    return {'path': str(detected.path), 'timestamps': [ts._asdict() for ts in detected.timestamps]}
+
+def clean_job(job: Job) -> Dict[str, Any]:
+    from clean_timestamps import CleanTimestamps, VoiceDetect
+    cleaned = CleanTimestamps.clean(VoiceDetect(**job.input), job.params.get('timestamp_merge_window', 1))
+    return {'path': str(cleaned.path), 'timestamps': [ts._asdict() for ts in cleaned.clean_timestamps]}
+
+def output_root(job: Job, path: str) -> Path:
+    """
+    Where a job writes: params['output_directory'], by default next to the source file so every host sees it.
+    """
+    return Path(job.params.get('output_directory') or Path(path).parent)
+
+def output_directory(job: Job, path: str) -> Path:
+    """
+    Parts go to <output root>/<file stem> (see output_root).
+    """
+    output_directory = output_root(job, path) / Path(path).stem
+    os.makedirs(output_directory, exist_ok=True)
+    return output_directory
+
+def split_job(job: Job) -> Dict[str, Any]:
+    from split_by_timestamp import Split
+    path = job.input['path']
+    directory = output_directory(job, path)
+    split = Split.get_ranges(path, job.input['timestamps'])
+    outputs = Split.export_ranges(path, [(directory / output_path, part_range) for output_path, part_range in split.output_paths_and_parts])
+    return {'outputs': [str(output_path) for output_path in outputs]}
+
+def clip_job(job: Job) -> Dict[str, Any]:
+    from clip_and_export_audio import Clips
+    directory = output_directory(job, job.path)
+    clips = Clips.get_partition_ranges(job.path, job.params.get('cutoff_threshold', 3600), job.params.get('chunk_duration', 1800))
+    outputs = [Clips.copy_range(job.path, directory / Path(output_path).name, *part_range)
+               for output_path, part_range in clips.output_paths_and_parts]
+    return {'outputs': [str(output_path) for output_path in outputs]}
+
+STAGE_JOBS: Dict[str, Callable[[Job], Any]] = {
+    'convert': convert_job,
+    'detect': detect_job,
+    'clean': clean_job,
+    'split': split_job,
+    'clip': clip_job
+}
+
+def run_job(queue: WorkQueue, job: Job, worker: str, lease_seconds: float, heartbeat_seconds: float) -> bool:
+    """
+    Runs one leased job with a heartbeat thread keeping the lease alive, then reports the outcome.
+    """
+    stop = threading.Event()
+
+    def beat():
+        # its own connection: sqlite3 connections don't cross threads
+        beat_queue = WorkQueue(queue.db_path)
+        try:
+            while not stop.wait(heartbeat_seconds):
+                if not beat_queue.heartbeat(job, worker, lease_seconds):
+                    logger.info(f"Lost the lease on job {job.id}")
+                    return
+        finally:
+            beat_queue.close()
+
+    heart = threading.Thread(target=beat, name=f'heartbeat-{job.id}', daemon=True)
+    heart.start()
+    try:
+        with measure(f'queue.{job.stage}'):
+            result = STAGE_JOBS[job.stage](job)
+    except Exception as e:
+        stop.set()
+        heart.join()
+        logger.info(f"Job {job.id} ({job.stage} {job.path}) failed: {e!r}")
+        queue.fail(job, worker, repr(e), drain())
+        return False
+    stop.set()
+    heart.join()
+    return queue.complete(job, worker, result, drain())
+
+def run_worker(db_path: Path,
+               lease_seconds: float = 60,
+               heartbeat_seconds: float = 10,
+               poll_seconds: float = 1,
+               exit_when_idle: bool = True) -> int:
+    """
+    Worker loop: leases and runs jobs until the queue is drained (or forever, without exit_when_idle).
+    Returns the number of jobs this worker completed.
+    """
+    t1_start = perf_counter()
+    worker = worker_name()
+    queue = WorkQueue(db_path)
+    done = 0
+    try:
+        while True:
+            job = queue.lease(worker, lease_seconds)
+            if job is None:
+                # other workers' jobs may still queue follow-up stages
+                if exit_when_idle and queue.pending() == 0:
+                    break
+                time.sleep(poll_seconds)
+                continue
+            logger.info(f"Worker {worker} running job {job.id}: {job.stage} {job.path} (attempt {job.attempts})")
+            done += run_job(queue, job, worker, lease_seconds, heartbeat_seconds)
+    finally:
+        queue.close()
+    t1_stop = perf_counter()
+    logger.info(f"Worker {worker} finished {done} jobs. Elapsed time: {t1_stop - t1_start}")
+    return done
+
+def run_workers(db_path: Path, num_workers: int = None, **worker_options: Any) -> Dict[str, Any]:
+    """
+    Starts num_workers worker processes on this machine against one queue file and waits for them.
+    Run it on several hosts against the same file to scale out.
+    """
+    t1_start = perf_counter()
+    processes = [multiprocessing.Process(target=run_worker, args=(db_path,), kwargs=worker_options)
+                 for _ in range(num_workers or os.cpu_count())]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    queue = WorkQueue(db_path)
+    report = queue.report()
+    queue.close()
+    t1_stop = perf_counter()
+    logger.info(f"Task complete! Elapsed time: {t1_stop - t1_start}")
+    return report
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='SQLite work queue for the splice_n_stamp stages')
+    parser.add_argument('command', choices=['enqueue', 'work', 'status'])
+    parser.add_argument('--db', default='work_queue.db')
+    parser.add_argument('--glob', help='files to enqueue')
+    parser.add_argument('--stage', choices=STAGES, default='convert')
+    parser.add_argument('--params', default='{}', help='JSON stage params, e.g. {"input_type": "mp3", "timestamp_merge_window": 1}')
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--lease-seconds', type=float, default=60)
+    parser.add_argument('--heartbeat-seconds', type=float, default=10)
+    parser.add_argument('--journal-mode', default='DELETE', help='journal mode of a new queue file, e.g. WAL')
+    args = parser.parse_args()
+    # creates the queue file with the chosen journal mode if it isn't there yet
+    work_queue = WorkQueue(args.db, args.journal_mode)
+    if args.command == 'enqueue':
+        work_queue.enqueue(glob(args.glob), args.stage, json.loads(args.params))
+        work_queue.close()
+    elif args.command == 'work':
+        work_queue.close()
+        report = run_workers(args.db, args.workers, lease_seconds=args.lease_seconds, heartbeat_seconds=args.heartbeat_seconds)
+        print(json.dumps(report, indent=2))
+    else:
+        print(json.dumps(work_queue.report(), indent=2))
+        work_queue.close()
@@ -0,0 +1,48 @@
+import os
+import atexit
+from concurrent.futures import ProcessPoolExecutor
+from loguru import logger
+
+# one pool for the whole session, shared by the convert, detect, split and clip stages
+_process_pool: ProcessPoolExecutor = None
+_max_workers: int = None
+
+def warm_up() -> None:
+    """
+    Runs once when each worker starts: imports the modules every task needs so tasks don't pay for them.
+    pydub is left out: only the legacy segment paths use it, and they import it themselves.
+    """
+    import numpy
+    import pydantic
+    import webrtcvad
+    import convert_audio
+    import voice_audio_timestamps
+    import split_by_timestamp
+    import clip_and_export_audio
+
+def get_process_pool(max_workers: int = None) -> ProcessPoolExecutor:
+    """
+    Returns the shared process pool, starting it on first use.
+    max_workers defaults to the CPU count. Passing a different size than the running pool
+    shuts it down and starts a new one; passing None reuses whatever is running.
+    """
+    global _process_pool, _max_workers
+    if _process_pool is not None and max_workers is not None and max_workers != _max_workers:
+        shutdown_process_pool()
+    if _process_pool is None:
+        _max_workers = max_workers or os.cpu_count()
+        _process_pool = ProcessPoolExecutor(_max_workers, initializer=warm_up)
+        logger.info(f"Started process pool with {_max_workers} workers")
+    return _process_pool
+
+def pool_size() -> int:
+    return _max_workers or os.cpu_count()
+
+def shutdown_process_pool() -> None:
+    global _process_pool, _max_workers
+    if _process_pool is not None:
+        _process_pool.shutdown()
+        _process_pool = None
+        _max_workers = None
+
+atexit.register(shutdown_process_pool)